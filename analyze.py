@@ -0,0 +1,258 @@
+"""
+Statistics about a profile's prompt space and about generated output.
+
+space_stats() works out from the option tables alone how many distinct
+prompts a profile can produce and how many duplicates N random draws are
+expected to contain. OutputStats counts how often every option was used in
+existing prompt files, from the .choices sidecar of their run where there is
+one and from the prompt text otherwise, with the number of distinct prompts
+estimated by a HyperLogLog sketch, so gigabytes of output are analyzed in a
+fixed amount of memory.
+"""
+import re
+import math
+import random
+import hashlib
+
+from choices import choices_paths, read_header, iter_choices
+from engine import category_picks, extra_columns
+
+# The prompt of an A1111 prompts-from-file line
+PROMPT_ARGUMENT = re.compile(r'--prompt\s+"((?:[^"\\]|\\.)*)"')
+
+# The -NNN ending of a chunk of a chunked output
+CHUNK_SUFFIX = re.compile(r'-\d{3}$')
+
+# Random combinations checked to estimate how much of the space rules allow
+RULE_SAMPLES = 20000
+
+def expected_distinct(space, draws):
+    """Expected number of distinct prompts in draws uniform draws from space"""
+    if not space or not draws:
+        return 0.0
+    # space * (1 - (1 - 1/space) ** draws), stable for huge spaces
+    return -space * math.expm1(draws * math.log1p(-1.0 / space)) if space > 1 else 1.0
+
+def rules_fraction(sizes, rules, rng=None, samples=RULE_SAMPLES):
+    """Estimated share of all combinations a CompiledRules table allows"""
+    if not rules:
+        return 1.0
+    rng = rng or random.Random(0)
+    valid = 0
+    for _ in range(samples):
+        choice = [rng.randrange(size) for size in sizes]
+        allowed = rules.full_masks
+        for cat_index, option in enumerate(choice):
+            if not allowed[cat_index] >> option & 1:
+                break
+            allowed = rules.restrict(cat_index, option, allowed)
+            if allowed is None:
+                break
+        else:
+            valid += 1
+    return valid / samples
+
+def category_ways(size, include=1.0, picks=(1, 1)):
+    """Number of ways a category of size distinct options can appear in a prompt.
+
+    An optional category can also be left out, and a category with several
+    picks contributes any set of between fewest and most different options.
+    """
+    low, high = picks
+    counts = set(range(min(low, size), min(high, size) + 1)) if include > 0 else set()
+    if include < 1:
+        counts.add(0)
+    return sum(math.comb(size, count) for count in counts)
+
+def space_stats(category_names, option_lists, draws=0, rules=None, include=None, picks=None):
+    """Size of the prompt space and the duplicates expected in draws prompts.
+
+    include and picks (see engine.category_picks()) count optional
+    categories and several picks per category. Options repeated in a
+    category file render the same prompt, so each counts once.
+    """
+    sizes = [len(set(options)) for options in option_lists]
+    include = include or [1.0] * len(sizes)
+    picks = picks or [(1, 1)] * len(sizes)
+    ways = [category_ways(size, p, pick) for size, p, pick in zip(sizes, include, picks)]
+    space = math.prod(ways) if ways else 0
+    fraction = rules_fraction([len(options) for options in option_lists], rules)
+    valid = space * fraction
+    distinct = expected_distinct(valid, draws)
+    return {
+        'categories': dict(zip(category_names, sizes)),
+        'ways': dict(zip(category_names, ways)),
+        'space': space,
+        'rules_fraction': fraction,
+        'valid_space': valid,
+        'draws': draws,
+        'expected_distinct': distinct,
+        'expected_duplicates': draws - distinct,
+        'remaining_after_dedup': valid - distinct,
+        # Draws after which a repeat is more likely than not (birthday bound)
+        'draws_to_first_duplicate': math.sqrt(2 * valid * math.log(2)) if valid else 0,
+    }
+
+class HyperLogLog(object):
+    """Fixed-size estimate of the number of distinct strings seen"""
+    def __init__(self, precision=14):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(self.size)
+
+    def add(self, text):
+        value = int.from_bytes(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest(), 'big')
+        index = value >> (64 - self.precision)
+        rest = value & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def estimate(self):
+        m = self.size
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if raw <= 2.5 * m and zeros:
+            # Small range correction (linear counting)
+            return m * math.log(m / zeros)
+        return raw
+
+class OutputStats(object):
+    """Option usage and duplicate rate of generated prompt files.
+
+    A file whose run saved a .choices sidecar (SAVE_CHOICES=on) is counted
+    from the recorded option indices, once per run however many chunks and
+    formats it was written to; that is exact with templates, prefixes,
+    optional categories and several picks. Without a sidecar, or when the
+    category files changed since the run, every prompt is split back into
+    its options by matching the category tables in order; that only works
+    for plain ", " joined prompts, and parts that match no current option
+    are counted as unknown. category_files (as from
+    engine.category_file_info()) lets a sidecar be checked against the
+    current files.
+    """
+    def __init__(self, category_names, option_lists, category_files=None):
+        self.category_names = category_names
+        self.option_lists = option_lists
+        self.option_sets = [set(options) for options in option_lists]
+        self.counts = [dict.fromkeys(options, 0) for options in option_lists]
+        self.hashes = [info['sha256'] for info in category_files] if category_files else None
+        self.omitted = [0] * len(category_names)
+        self.unknown = 0
+        self.lines = 0
+        self.prompts = HyperLogLog()
+        self.sidecars = set()
+        # Files counted from their prompt text, and those whose sidecar is out of date
+        self.text_files = []
+        self.stale_files = []
+
+    def add_file(self, path):
+        sidecar = self._sidecar(path)
+        if sidecar is not None:
+            matrix, header = sidecar
+            if matrix not in self.sidecars:
+                self.sidecars.add(matrix)
+                self.add_choices(matrix, header)
+            return
+        lines = self.lines
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                match = PROMPT_ARGUMENT.search(line)
+                if match:
+                    self.add_prompt(match.group(1))
+        if self.lines > lines:
+            self.text_files.append(str(path))
+
+    def _sidecar(self, path):
+        """(matrix path, header) of the run a file belongs to, None if there is no usable one"""
+        path = str(path)
+        candidates = [path]
+        stem, dot, suffix = path.rpartition('.')
+        if CHUNK_SUFFIX.search(stem):
+            candidates.append(stem[:-4] + dot + suffix)
+        for candidate in candidates:
+            matrix = choices_paths(candidate)[0]
+            if not matrix.exists():
+                continue
+            try:
+                header = read_header(matrix)[1]
+            except (OSError, ValueError):
+                continue
+            count = len(self.category_names)
+            if (header['categories'] != list(self.category_names)
+                    or header['sizes'][:count] != [len(options) for options in self.option_lists]
+                    or (self.hashes and [info['sha256'] for info in header['category_files']] != self.hashes)):
+                self.stale_files.append(path)
+                return None
+            return matrix, header
+        return None
+
+    def add_choices(self, matrix, header):
+        """Count every prompt recorded in a choice matrix"""
+        picks = category_picks(header['categories'], header.get('profile'))[1]
+        column_categories = list(range(len(header['categories']))) + extra_columns(picks)
+        option_lists = self.option_lists
+        counts = self.counts
+        omitted = self.omitted
+        for row in iter_choices(matrix, header):
+            self.lines += 1
+            texts = []
+            for column, i in enumerate(row):
+                cat_index = column_categories[column]
+                if i >= 0:
+                    option = option_lists[cat_index][i]
+                    counts[cat_index][option] += 1
+                    texts.append(option)
+                else:
+                    if column == cat_index:
+                        omitted[cat_index] += 1
+                    texts.append('')
+            # By option text, so repeated lines in a category file count as one prompt
+            self.prompts.add('\x1f'.join(texts))
+
+    def add_prompt(self, prompt_text):
+        self.lines += 1
+        self.prompts.add(prompt_text)
+        rest = prompt_text
+        for cat_index, options in enumerate(self.option_sets):
+            option = self._match(rest, options)
+            if option is None:
+                self.omitted[cat_index] += 1
+                continue
+            self.counts[cat_index][option] += 1
+            rest = rest[len(option) + 2:]
+        if rest:
+            self.unknown += 1
+
+    @staticmethod
+    def _match(text, options):
+        """Longest option text is made of, cut at a ", " boundary"""
+        end = len(text)
+        while end > 0:
+            if text[:end] in options:
+                return text[:end]
+            end = text.rfind(', ', 0, end)
+        return None
+
+    def report(self):
+        distinct = min(self.prompts.estimate(), self.lines)
+        categories = {}
+        for name, counts, omitted in zip(self.category_names, self.counts, self.omitted):
+            used = sum(1 for count in counts.values() if count)
+            categories[name] = {
+                'options': len(counts),
+                'used': used,
+                'coverage': used / len(counts) if counts else 0,
+                'omitted': omitted,
+                'counts': counts,
+            }
+        return {
+            'lines': self.lines,
+            'distinct_estimate': distinct,
+            'duplicate_rate': 1 - distinct / self.lines if self.lines else 0,
+            'unmatched': self.unknown,
+            'text_files': self.text_files,
+            'stale_choices': self.stale_files,
+            'categories': categories,
+        }
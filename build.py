@@ -1,10 +1,44 @@
 import os
 import sys
+import time
 import shutil
+import argparse
+import statistics
+import subprocess
 import PyInstaller.__main__
 import platform
 from pathlib import Path
 
+APP_NAME = 'A1111-Prompt-Generator'
+
+# Standard library and build-time modules the application never imports,
+# left out of the bundle so there is less to unpack and load at launch
+EXCLUDED_MODULES = [
+    'unittest',
+    'doctest',
+    'pdb',
+    'pydoc',
+    'pydoc_data',
+    'lib2to3',
+    'distutils',
+    'setuptools',
+    'pkg_resources',
+    'pip',
+    'xmlrpc',
+    'idlelib',
+    'turtle',
+    'turtledemo',
+    'tkinter.test',
+    'test',
+    'PIL',
+    # Only reached through python-dotenv's optional IPython extension
+    'IPython',
+    'jedi',
+]
+
+# Launcher flag that loads the application and exits before opening a window
+STARTUP_CHECK_FLAG = '--startup-check'
+
 def get_resource_path(relative_path):
     """ Get absolute path to resource, works for dev and for PyInstaller """
     try:
@@ -14,9 +48,29 @@ def get_resource_path(relative_path):
         base_path = os.path.abspath(".")
     return os.path.join(base_path, relative_path)
 
-def build():
+def executable_path(distpath, onedir=False):
+    """Where PyInstaller puts the built executable"""
+    suffix = '.exe' if platform.system() == 'Windows' else ''
+    if platform.system() == 'Darwin':
+        return Path(distpath) / f'{APP_NAME}.app' / 'Contents' / 'MacOS' / APP_NAME
+    if onedir:
+        return Path(distpath) / APP_NAME / f'{APP_NAME}{suffix}'
+    return Path(distpath) / f'{APP_NAME}{suffix}'
+
+def measure_startup(executable, runs=5):
+    """Seconds from launch until the built application is ready, first and median of runs"""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([str(executable), STARTUP_CHECK_FLAG], check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return times[0], statistics.median(times)
+
+def build(onedir=False, distpath='dist', workpath='build'):
+    """Build the application; onedir makes the unpacked fast-start distribution"""
     # Clean up previous builds
-    for item in ['build', 'dist']:
+    for item in [workpath, distpath]:
         if os.path.exists(item):
             shutil.rmtree(item, ignore_errors=True)
     
@@ -25,7 +79,7 @@ def build():
     os.makedirs('profiles', exist_ok=True)
     
     # PyInstaller configuration
-    app_name = 'A1111-Prompt-Generator'
+    app_name = APP_NAME
     script_path = 'launch.py'  # Use the launcher as entry point
     icon_path = 'icon.ico' if os.path.exists('icon.ico') else None
     
@@ -33,14 +87,19 @@ def build():
     current_dir = Path('.').resolve()
     data_dir = str(current_dir / 'data')
     profiles_dir = str(current_dir / 'profiles')
+    clip_vocab_dir = str(current_dir / 'config' / 'clip')
     
     # Base command
     cmd = [
         script_path,
         '--name', app_name,
-        '--onefile',
+        # onedir starts without unpacking the bundle to a temporary folder first
+        '--onedir' if onedir else '--onefile',
         '--windowed',  # For GUI apps
+        '--distpath', distpath,
+        '--workpath', workpath,
         '--add-data', f'{profiles_dir}{os.pathsep}profiles',
+        '--add-data', f'{clip_vocab_dir}{os.pathsep}config/clip',  # CLIP vocabulary for token budgets
         '--noconfirm',  # Overwrite output directory without confirmation
         '--clean',  # Clean PyInstaller cache and remove temporary files
     ]
@@ -99,6 +158,9 @@ def build():
     
     for imp in hidden_imports:
         cmd.extend(['--hidden-import', imp])
+
+    for module in EXCLUDED_MODULES:
+        cmd.extend(['--exclude-module', module])
     
     print("Starting build with command:", ' '.join(cmd))
     
@@ -106,7 +168,7 @@ def build():
     try:
         PyInstaller.__main__.run(cmd)
         print("\n✅ Build completed successfully!")
-        print(f"📁 Executable is in: {os.path.abspath('dist')}")
+        print(f"📁 Executable is in: {os.path.abspath(distpath)}")
         
         # On macOS, print additional instructions
         if platform.system() == 'Darwin':
@@ -123,5 +185,26 @@ def build():
     
     return 0
 
+def compare():
+    """Build both distributions and compare how fast each starts"""
+    results = {}
+    for onedir, label in [(False, 'onefile'), (True, 'onedir')]:
+        if build(onedir, os.path.join('dist', label), os.path.join('build', label)):
+            return 1
+        results[label] = measure_startup(executable_path(os.path.join('dist', label), onedir))
+    print("\nStartup time (first launch / median of 5):")
+    for label, (first, median) in results.items():
+        print(f"  {label:8} {first:6.2f}s / {median:6.2f}s")
+    return 0
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Build the A1111 Prompt Generator with PyInstaller")
+    parser.add_argument('--onedir', action='store_true',
+                        help="Build an unpacked folder that starts faster than the single-file executable")
+    parser.add_argument('--compare', action='store_true',
+                        help="Build both kinds and measure how fast each one starts")
+    return parser.parse_args(argv)
+
 if __name__ == "__main__":
-    sys.exit(build())
+    args = parse_args()
+    sys.exit(compare() if args.compare else build(args.onedir))
@@ -0,0 +1,93 @@
+"""
+Checkpoints for long generation runs.
+
+Every CHECKPOINT_EVERY lines, at the end of a prompt, the output files are
+flushed and fsynced and a small sidecar (<output stem>.checkpoint.json) is
+replaced atomically with the run's position: lines written, prompts drawn,
+the byte size of every file and the sampler's generator state. If the
+process dies, "python cli.py resume" truncates the files back to the last
+checkpoint and carries on from there, producing the same output as a run
+that was never interrupted. The sidecar is removed when the run completes.
+"""
+import os
+import json
+from pathlib import Path
+
+CHECKPOINT_VERSION = 1
+
+def checkpoint_path(output_path):
+    """Path of the checkpoint sidecar of an output file"""
+    output_path = Path(output_path)
+    return output_path.with_name(f"{output_path.stem}.checkpoint.json")
+
+def _fsync(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+def write_checkpoint(path, state):
+    """Atomically replace a checkpoint file"""
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+        _fsync(f)
+    os.replace(temp_path, path)
+
+def read_checkpoint(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        state = json.load(f)
+    if state.get('version') != CHECKPOINT_VERSION:
+        raise ValueError(f"{path} is not a checkpoint this version can resume")
+    return state
+
+def truncate_files(sizes):
+    """Cut files back to the sizes recorded in a checkpoint"""
+    for filename, size in sizes.items():
+        with open(filename, 'r+b') as f:
+            f.truncate(size)
+
+class Checkpointer(object):
+    """Saves a run's position every `every` lines, at prompt boundaries.
+
+    run is the part of the checkpoint that doesn't change during the run
+    (settings, seeds, profile); sampler and progress are the run's
+    PromptSampler and RunProgress. on_save is called before every
+    checkpoint, e.g. to flush the manifest's pending rows, and files are
+    further open files to sync and record along with the output.
+    """
+    def __init__(self, output_path, every, run, sampler, progress, on_save=None, files=None):
+        self.path = checkpoint_path(output_path)
+        self.every = every
+        self.run = run
+        self.sampler = sampler
+        self.progress = progress
+        self.on_save = on_save
+        self.files = files or []
+        self.next_at = progress.lines + every
+
+    def due(self, lines):
+        """True if a checkpoint should be taken after this many lines"""
+        return lines >= self.next_at and self.progress.at_boundary
+
+    def save(self, lines, files):
+        """Flush and fsync the open files, then record the position"""
+        if self.on_save:
+            self.on_save()
+        files = list(files) + self.files
+        for f in files:
+            _fsync(f)
+        state = dict(self.run)
+        state.update({
+            'version': CHECKPOINT_VERSION,
+            'lines': lines,
+            'draws': self.progress.draws,
+            'prompts': self.progress.prompts,
+            'sizes': {os.path.abspath(f.name): f.tell() for f in files},
+            'sampler': self.sampler.get_state(),
+        })
+        write_checkpoint(self.path, state)
+        self.next_at = lines + self.every
+
+    def finish(self):
+        """Remove the checkpoint once the run has completed"""
+        if self.path.exists():
+            self.path.unlink()
@@ -0,0 +1,108 @@
+"""
+Choice-index sidecars: re-render a run without resampling it.
+
+With SAVE_CHOICES=on a run also writes the option indices of every prompt:
+<stem>.choices holds one row of unsigned integers per prompt (one column
+per category, 0xFFFF / 0xFFFFFFFF for a category left out) and
+<stem>.choices.json describes them (categories, file hashes, seeds and
+settings of the run). "python cli.py rerender" turns the matrix back into a
+prompts file with the current category files and settings, so a typo fix or
+a new CFG value keeps exactly the same combinations.
+"""
+import sys
+import json
+from array import array
+from pathlib import Path
+
+CHOICES_VERSION = 1
+
+# Rows read at a time when replaying a matrix
+READ_ROWS = 65536
+
+def choices_paths(output_path):
+    """Paths of the (matrix, header) sidecars of an output file"""
+    output_path = Path(output_path)
+    return (output_path.with_name(f"{output_path.stem}.choices"),
+            output_path.with_name(f"{output_path.stem}.choices.json"))
+
+def _typecode(sizes):
+    return 'H' if max(sizes, default=0) < 0xFFFF else 'I'
+
+class ChoiceRecorder(object):
+    """Sampler filter that appends the indices of every accepted prompt to the matrix"""
+    def __init__(self, output_path, sizes, header, append=False):
+        self.path, self.header_path = choices_paths(output_path)
+        self.typecode = _typecode(sizes)
+        self.missing = (1 << (8 * array(self.typecode).itemsize)) - 1
+        if not append:
+            header = dict(header, version=CHOICES_VERSION, typecode=self.typecode,
+                          itemsize=array(self.typecode).itemsize, byteorder=sys.byteorder, sizes=sizes)
+            with open(self.header_path, 'w', encoding='utf-8') as f:
+                json.dump(header, f, indent=4)
+        self.file = open(self.path, 'ab' if append else 'wb')
+        self.rows = array(self.typecode)
+
+    def seen(self, choice, prompt_text):
+        return False
+
+    def add(self, choice, prompt_text):
+        missing = self.missing
+        self.rows.extend(missing if i < 0 else i for i in choice)
+        if len(self.rows) >= READ_ROWS:
+            self.flush()
+
+    def flush(self):
+        self.rows.tofile(self.file)
+        self.rows = array(self.typecode)
+        self.file.flush()
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+def read_header(path):
+    """Load a .choices.json header (path may also be the output file or the matrix)"""
+    path = Path(path)
+    if path.suffix != '.json':
+        if path.suffix == '.choices':
+            path = path.with_name(path.name + '.json')
+        else:
+            path = choices_paths(path)[1]
+    with open(path, 'r', encoding='utf-8') as f:
+        header = json.load(f)
+    if header.get('version') != CHOICES_VERSION:
+        raise ValueError(f"{path} is not a choices file this version can read")
+    return path, header
+
+def iter_choices(matrix_path, header):
+    """Yield every row of a choice matrix as a tuple, reading it in blocks"""
+    width = len(header['sizes'])
+    missing = (1 << (8 * header['itemsize'])) - 1
+    swap = header['byteorder'] != sys.byteorder
+    with open(matrix_path, 'rb') as f:
+        while True:
+            block = array(header['typecode'])
+            data = f.read(READ_ROWS * width * block.itemsize)
+            if not data:
+                return
+            block.frombytes(data[:len(data) - len(data) % (width * block.itemsize)])
+            if swap:
+                block.byteswap()
+            for start in range(0, len(block), width):
+                yield tuple(-1 if i == missing else i for i in block[start:start + width])
+
+class ReplaySampler(object):
+    """Stands in for a PromptSampler, handing out recorded choices in order"""
+    def __init__(self, option_lists, rows, rng, render):
+        self.option_lists = option_lists
+        self.rows = rows
+        self.rng = rng
+        self.render = render
+        self.rejected = 0
+        # Replayed choices are never re-seeded
+        self.block_base = None
+
+    def next_prompt(self):
+        choice = next(self.rows)
+        return choice, self.render(choice)
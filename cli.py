@@ -0,0 +1,479 @@
+#!/usr/bin/env python3
+"""
+Command line interface for the A1111 Prompt Generator.
+
+Runs the same generation engine as the GUI without opening a window:
+
+    python cli.py batch "config/profiles/*" --count 500 --jobs 4
+    python cli.py stream Portraits --format jsonl | head -n 1000
+    python cli.py serve Portraits --port 7861
+    python cli.py batch Portraits --count 100000 --seed 42 --shard 2/4
+"""
+import os
+import sys
+import glob
+import json
+import random
+import argparse
+import contextlib
+import hashlib
+from datetime import datetime
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from engine import (
+    PROFILES_DIR, OUTPUT_DIR, OptionCache, load_settings, load_profile, load_profile_tables,
+    run_generation, resume_generation, rerender_run, allocate_output_path, setting_enabled, category_picks,
+    category_file_info, OUTPUT_FORMATS
+)
+from checkpoint import checkpoint_path
+from shards import parse_shard, file_checksums, run_files, load_shard, verify_shards, merge_shards
+from manifest import RunManifest, MANIFEST_FILENAME
+from analyze import PROMPT_ARGUMENT
+
+def resolve_profiles(patterns):
+    """Expand profile names, paths and glob patterns into profile directories"""
+    profiles = []
+    for pattern in patterns:
+        candidates = glob.glob(pattern) or glob.glob(str(PROFILES_DIR / pattern))
+        if not candidates:
+            print(f"Warning: no profile matches '{pattern}'")
+        for candidate in sorted(candidates):
+            path = Path(candidate)
+            if not (path / 'profile.json').exists():
+                continue
+            if path.resolve() not in [p.resolve() for p in profiles]:
+                profiles.append(path)
+    return profiles
+
+def parse_overrides(items):
+    """Turn KEY=VALUE command line overrides into a dict"""
+    overrides = {}
+    for item in items or []:
+        if '=' not in item:
+            raise argparse.ArgumentTypeError(f"Expected KEY=VALUE, got '{item}'")
+        key, value = item.split('=', 1)
+        overrides[key.strip().upper()] = value.strip()
+    return overrides
+
+def profile_rng_seed(master_seed, profile_name):
+    """Per-profile generator seed derived from the batch master seed"""
+    digest = hashlib.blake2b(f"{master_seed}:{profile_name}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+def _run_profile_job(job):
+    """Generate one profile of a batch (runs in a worker process)"""
+    name, profile_path, profile, options, negative_prompt, settings, count, output_path, rng_seed, shard = job
+    try:
+        result = run_generation(profile.get('categories', []), options, settings, count, output_path,
+                                negative_prompt, profile, profile_path, rng_seed, shard=shard)
+        if shard is not None:
+            result['checksums'] = file_checksums(Path(output_path).parent, run_files(result))
+    except Exception as e:
+        result = {'output': None, 'error': str(e)}
+    result.update({'profile': name, 'profile_path': str(profile_path), 'rng_seed': rng_seed})
+    return result
+
+def cmd_batch(args):
+    profiles = resolve_profiles(args.profiles)
+    if not profiles:
+        print("No profiles to generate")
+        return 1
+
+    settings = load_settings()
+    settings.update(parse_overrides(args.set))
+    master_seed = args.seed if args.seed is not None else random.randrange(2**63)
+    shard = None
+    if args.shard:
+        if args.seed is None:
+            print("--shard needs --seed, so that every machine generates the same run")
+            return 1
+        try:
+            shard = parse_shard(args.shard, args.count)
+        except ValueError as e:
+            print(e)
+            return 1
+        print(f"Shard {args.shard}: prompts {shard[0]}:{shard[1]} of {args.count}")
+
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    output_dir = Path(args.output) if args.output else OUTPUT_DIR / f"batch-{stamp}"
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Read every profile's tables up front, concurrently, through one shared cache
+    cache = OptionCache()
+    with ThreadPoolExecutor(max_workers=min(8, len(profiles))) as pool:
+        normalize = setting_enabled(settings, 'NORMALIZE_OPTIONS')
+        loaded = list(pool.map(lambda path: _load_for_batch(path, cache, normalize), profiles))
+    print(f"Loaded {len(profiles)} profiles ({cache.misses} files read, {cache.hits} shared)")
+
+    jobs = []
+    results = []
+    for path, (tables, error) in zip(profiles, loaded):
+        if error:
+            print(f"  {path.name}: {error}")
+            results.append({'profile': path.name, 'profile_path': str(path), 'output': None, 'error': error})
+            continue
+        profile, options, negative_prompt = tables
+        output_path = output_dir / f"{path.name}.txt"
+        jobs.append((path.name, path, profile, options, negative_prompt, settings, args.count,
+                     output_path, profile_rng_seed(master_seed, path.name), shard))
+
+    workers = args.jobs or os.cpu_count() or 1
+    if workers == 1 or len(jobs) <= 1:
+        finished = map(_run_profile_job, jobs)
+        results.extend(_report(finished))
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as pool:
+            results.extend(_report(pool.map(_run_profile_job, jobs)))
+
+    manifest = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'count': args.count,
+        'master_seed': master_seed,
+        'settings': settings,
+        'shard': {'spec': args.shard, 'start': shard[0], 'end': shard[1]} if shard else None,
+        'runs': results,
+    }
+    manifest_path = output_dir / 'manifest.json'
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=4)
+    print(f"Wrote {manifest_path}")
+    return 1 if any(r.get('error') for r in results) else 0
+
+def _load_for_batch(path, cache, normalize=False):
+    try:
+        return load_profile_tables(path, cache, normalize), None
+    except Exception as e:
+        return None, str(e)
+
+def _report(results):
+    for result in results:
+        if result.get('error'):
+            print(f"  {result['profile']}: failed: {result['error']}")
+        else:
+            print(f"  {result['profile']}: {result['lines']} lines -> {result['output']}")
+        yield result
+
+def cmd_stream(args):
+    stdout = sys.stdout
+    # Messages go to stderr so they never end up in the streamed prompts
+    with contextlib.redirect_stdout(sys.stderr):
+        return _stream_profile(args, stdout)
+
+def _stream_profile(args, stdout):
+    profiles = resolve_profiles([args.profile])
+    if len(profiles) != 1:
+        print(f"'{args.profile}' must name exactly one profile")
+        return 1
+    profile_path = profiles[0]
+
+    settings = load_settings()
+    settings.update(parse_overrides(args.set))
+    profile, options, negative_prompt = load_profile_tables(
+        profile_path, normalize=setting_enabled(settings, 'NORMALIZE_OPTIONS'))
+    count = args.count if args.count > 0 else None
+
+    if args.output == '-':
+        stream, name = stdout, '<stdout>'
+    else:
+        # Opening a FIFO blocks until a reader connects
+        stream, name = open(args.output, 'w', encoding='utf-8'), args.output
+    try:
+        result = run_generation(profile.get('categories', []), options, settings, count, name,
+                                negative_prompt, profile, profile_path, args.seed,
+                                stream=stream, output_format=args.format)
+    finally:
+        if stream is not stdout:
+            try:
+                stream.close()
+            except BrokenPipeError:
+                pass
+    print(f"Streamed {result['lines']} lines (rng_seed={result['rng_seed']})")
+    return 0
+
+def cmd_analyze(args):
+    # Keep messages out of the JSON report
+    with contextlib.redirect_stdout(sys.stderr if args.json else sys.stdout):
+        report = _analyze(args)
+    if report is None:
+        return 1
+    if args.json:
+        print(json.dumps(report, indent=4))
+    else:
+        _print_analysis(report, args.top)
+    return 0
+
+def _analyze(args):
+    from analyze import space_stats, OutputStats
+    from rules import compile_rules
+    profiles = resolve_profiles([args.profile])
+    if len(profiles) != 1:
+        print(f"'{args.profile}' must name exactly one profile")
+        return None
+    settings = load_settings()
+    profile, options, _ = load_profile_tables(profiles[0], normalize=setting_enabled(settings, 'NORMALIZE_OPTIONS'))
+    category_names = profile.get('categories', [])
+    option_lists = [options[cat] for cat in category_names]
+    report = {'profile': profiles[0].name}
+    include, picks = category_picks(category_names, profile)
+    report['space'] = space_stats(category_names, option_lists, args.draws,
+                                  compile_rules(category_names, option_lists, profile), include, picks)
+
+    files = sorted({path for pattern in args.outputs or [] for path in glob.glob(pattern)})
+    if files:
+        stats = OutputStats(category_names, option_lists,
+                            category_file_info(category_names, profiles[0] / 'data'))
+        for path in files:
+            stats.add_file(path)
+        report['output'] = stats.report()
+        report['output']['files'] = files
+    return report
+
+def _print_analysis(report, top):
+    space = report['space']
+    print(f"Profile {report['profile']}")
+    factors = []
+    for cat, size in space['categories'].items():
+        ways = space['ways'][cat]
+        # Optional categories and several picks give a category more ways than options
+        factors.append(f"{cat} ({size})" if ways == size else f"{cat} ({size} options, {ways:,} ways)")
+    print("  " + " x ".join(factors))
+    print(f"  {space['space']:,} possible prompts")
+    if space['rules_fraction'] < 1:
+        print(f"  ~{space['valid_space']:,.0f} allowed by the rules ({space['rules_fraction']:.1%})")
+    print(f"  a repeat becomes likely after ~{space['draws_to_first_duplicate']:,.0f} prompts")
+    if space['draws']:
+        print(f"  {space['draws']:,} random prompts: ~{space['expected_duplicates']:,.0f} duplicates expected, "
+              f"~{space['remaining_after_dedup']:,.0f} unused prompts left")
+
+    output = report.get('output')
+    if not output:
+        return
+    print(f"\nOutput: {len(output['files'])} files, {output['lines']:,} prompts, "
+          f"~{output['distinct_estimate']:,.0f} distinct ({output['duplicate_rate']:.2%} duplicates)")
+    if output['text_files']:
+        print(f"  {len(output['text_files'])} files have no .choices sidecar matching the current category files;"
+              f" their options were matched in the prompt text, which misses templates, prefixes and extra picks"
+              f" (generate with SAVE_CHOICES=on for exact counts)")
+    if output['unmatched']:
+        print(f"  {output['unmatched']:,} prompts don't match the current category files")
+    for cat, stats in output['categories'].items():
+        print(f"\n  {cat}: {stats['used']}/{stats['options']} options used ({stats['coverage']:.0%})"
+              + (f", left out of {stats['omitted']:,} prompts" if stats['omitted'] else ""))
+        ranked = sorted(stats['counts'].items(), key=lambda item: -item[1])
+        shown = ranked if len(ranked) <= 2 * top else ranked[:top] + [None] + ranked[-top:]
+        most = ranked[0][1] if ranked else 0
+        for item in shown:
+            if item is None:
+                print("    ...")
+                continue
+            option, count = item
+            bar = '#' * (round(30 * count / most) if most else 0)
+            print(f"    {count:>9,}  {bar:<30}  {option}")
+
+def cmd_merge(args):
+    try:
+        manifests = [load_shard(shard_dir) for shard_dir in args.shards]
+    except (OSError, ValueError) as e:
+        print(f"Could not read shard manifest: {e}")
+        return 1
+    problems = verify_shards(manifests)
+    for problem in problems:
+        print(problem)
+    if problems:
+        return 1
+    print(f"{len(manifests)} shards cover all {manifests[0]['count']} prompts")
+    if args.check:
+        return 0
+    output_dir = Path(args.output) if args.output else OUTPUT_DIR / f"merged-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+    merged = merge_shards(manifests, output_dir)
+    for run in merged['runs']:
+        print(f"  {run['profile']}: {run['lines']} lines -> {', '.join(run['checksums'])}")
+    print(f"Merged into {output_dir}")
+    return 0
+
+def cmd_rerender(args):
+    output_path = Path(args.output) if args.output else allocate_output_path(OUTPUT_DIR)
+    try:
+        result = rerender_run(args.choices, output_path, parse_overrides(args.set))
+    except (OSError, ValueError) as e:
+        print(f"Could not re-render: {e}")
+        return 1
+    if result['changed']:
+        print(f"Using the current {', '.join(f'{cat}.txt' for cat in result['changed'])}")
+    print(f"Re-rendered {result['prompts']} prompts ({result['lines']} lines) -> {result['output']}")
+    return 0
+
+def cmd_resume(args):
+    path = Path(args.checkpoint)
+    if path.suffix == '.txt':
+        path = checkpoint_path(path)
+    if not path.exists():
+        print(f"No checkpoint at {path}")
+        return 1
+    try:
+        result = resume_generation(path)
+    except (OSError, ValueError) as e:
+        print(f"Could not resume: {e}")
+        return 1
+    print(f"Finished {result['output']}: {result['lines']} lines")
+    return 0
+
+def cmd_serve(args):
+    # Imported here so the other commands don't load the HTTP server
+    from server import serve
+    serve(args.host, args.port, args.profiles)
+    return 0
+
+def cmd_validate(args):
+    from validate import ValidationCache, validate_profile, format_problems, has_errors
+    profiles = resolve_profiles(args.profiles)
+    if not profiles:
+        print("No profiles to validate")
+        return 1
+    cache = ValidationCache()
+    failed = False
+    for path in profiles:
+        try:
+            profile = load_profile(path)
+        except (OSError, ValueError) as e:
+            print(f"{path.name}: error: profile.json could not be read ({e})")
+            failed = True
+            continue
+        problems = validate_profile(profile.get('categories', []), path / 'data', cache)
+        if not problems:
+            print(f"{path.name}: OK")
+            continue
+        print(f"{path.name}:")
+        for line in format_problems(problems).splitlines():
+            print(f"  {line}")
+        failed = failed or has_errors(problems)
+    cache.save()
+    return 1 if failed else 0
+
+def open_manifest(args):
+    path = Path(args.manifest) if args.manifest else OUTPUT_DIR / MANIFEST_FILENAME
+    if not path.exists():
+        print(f"No run manifest at {path}")
+        return None
+    return RunManifest(path)
+
+def _print_run(run):
+    status = f"{run['lines']} lines" if run['finished'] else "unfinished"
+    count = f"{run['count']} prompts" if run['count'] is not None else "endless"
+    print(f"#{run['id']}  {run['created']}  {run['profile'] or '(default)'}  "
+          f"{count}, {status}  rng_seed={run['rng_seed']}  -> {run['output']}")
+
+def cmd_runs(args):
+    manifest = open_manifest(args)
+    if manifest is None:
+        return 1
+    with manifest:
+        runs = manifest.list_runs(args.profile, args.since, args.limit)
+    for run in runs:
+        _print_run(run)
+    if not runs:
+        print("No matching runs")
+    return 0
+
+def cmd_which(args):
+    text = args.prompt
+    match = PROMPT_ARGUMENT.search(text)
+    if match:
+        text = match.group(1).replace('\\"', '"')
+    manifest = open_manifest(args)
+    if manifest is None:
+        return 1
+    with manifest:
+        runs = manifest.find_prompt(text)
+    for run in runs:
+        print(f"line {run['line']} of run:")
+        _print_run(run)
+    if not runs:
+        print("Prompt not found in any recorded run (prompts are only indexed with MANIFEST=prompts)")
+        return 1
+    return 0
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="A1111 Prompt Generator (headless)")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    batch = subparsers.add_parser('batch', help="Generate prompts for several profiles at once")
+    batch.add_argument('profiles', nargs='+', help="Profile names, directories or glob patterns")
+    batch.add_argument('--count', type=int, default=100, help="Prompts per profile (default: 100)")
+    batch.add_argument('--jobs', type=int, default=0, help="Worker processes (default: one per CPU)")
+    batch.add_argument('--seed', type=int, help="Master seed; makes the whole batch reproducible")
+    batch.add_argument('--output', help="Output directory (default: output/batch-<timestamp>)")
+    batch.add_argument('--set', action='append', metavar='KEY=VALUE',
+                       help="Override a setting from config/settings.txt (repeatable)")
+    batch.add_argument('--shard', metavar='I/N|START:END',
+                       help="Generate only this slice of the run (needs --seed), e.g. 2/8")
+    batch.set_defaults(func=cmd_batch)
+
+    merge = subparsers.add_parser('merge', help="Check shard folders of one run and join them")
+    merge.add_argument('shards', nargs='+', help="Output folders of the shards")
+    merge.add_argument('--output', help="Folder to write the merged run to")
+    merge.add_argument('--check', action='store_true', help="Only check the shards")
+    merge.set_defaults(func=cmd_merge)
+
+    stream = subparsers.add_parser('stream', help="Stream prompts to stdout or a named pipe")
+    stream.add_argument('profile', help="Profile name or directory")
+    stream.add_argument('--count', type=int, default=0,
+                        help="Prompts to generate (default: 0, until the reader closes the stream)")
+    stream.add_argument('--format', choices=sorted(OUTPUT_FORMATS), default='a1111',
+                        help="Line format (default: a1111)")
+    stream.add_argument('--output', default='-', help="File or named pipe to write to (default: - for stdout)")
+    stream.add_argument('--seed', type=int, help="Generator seed; makes the stream reproducible")
+    stream.add_argument('--set', action='append', metavar='KEY=VALUE',
+                        help="Override a setting from config/settings.txt (repeatable)")
+    stream.set_defaults(func=cmd_stream)
+
+    analyze = subparsers.add_parser('analyze', help="Prompt space and output statistics of a profile")
+    analyze.add_argument('profile', help="Profile name or directory")
+    analyze.add_argument('--draws', type=int, default=0, help="Expected duplicates for this many prompts")
+    analyze.add_argument('--outputs', nargs='+', metavar='GLOB',
+                         help="Generated prompt files to analyze, e.g. \"output/generated_prompts*.txt\"")
+    analyze.add_argument('--top', type=int, default=10, help="Most and least used options to show (default: 10)")
+    analyze.add_argument('--json', action='store_true', help="Print the full report as JSON")
+    analyze.set_defaults(func=cmd_analyze)
+
+    rerender = subparsers.add_parser('rerender', help="Rebuild a run's prompts from its saved choices")
+    rerender.add_argument('choices', help="The run's output file or its .choices.json")
+    rerender.add_argument('--output', help="File to write (default: the next generated_prompts file)")
+    rerender.add_argument('--set', action='append', metavar='KEY=VALUE',
+                          help="Change a setting of the run, e.g. CFG_SCALE=7 (repeatable)")
+    rerender.set_defaults(func=cmd_rerender)
+
+    resume = subparsers.add_parser('resume', help="Finish an interrupted run from its checkpoint")
+    resume.add_argument('checkpoint', help="The run's .checkpoint.json, or its output file")
+    resume.set_defaults(func=cmd_resume)
+
+    server = subparsers.add_parser('serve', help="Serve prompts over HTTP with warm caches")
+    server.add_argument('profiles', nargs='*', help="Profiles to load before the first request")
+    server.add_argument('--host', default='127.0.0.1', help="Address to listen on (default: 127.0.0.1)")
+    server.add_argument('--port', type=int, default=7861, help="Port to listen on (default: 7861)")
+    server.set_defaults(func=cmd_serve)
+
+    validate = subparsers.add_parser('validate', help="Check profiles' category files for problems")
+    validate.add_argument('profiles', nargs='+', help="Profile names, directories or glob patterns")
+    validate.set_defaults(func=cmd_validate)
+
+    runs = subparsers.add_parser('runs', help="List recorded generation runs")
+    runs.add_argument('--profile', help="Only runs of this profile")
+    runs.add_argument('--since', help="Only runs created on or after this date (YYYY-MM-DD)")
+    runs.add_argument('--limit', type=int, default=50, help="Show at most this many runs (default: 50)")
+    runs.add_argument('--manifest', help="Manifest file (default: output/manifest.sqlite)")
+    runs.set_defaults(func=cmd_runs)
+
+    which = subparsers.add_parser('which', help="Find the run that produced a prompt")
+    which.add_argument('prompt', help="Prompt text, or a whole line of a prompts file")
+    which.add_argument('--manifest', help="Manifest file (default: output/manifest.sqlite)")
+    which.set_defaults(func=cmd_which)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
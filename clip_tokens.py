@@ -0,0 +1,122 @@
+"""
+Offline CLIP token counting for prompt budgeting.
+
+A1111 encodes prompts in chunks of 75 CLIP tokens; a prompt that is one
+token over the limit is padded to a second chunk and roughly doubles the
+conditioning cost of every image. This module counts tokens with the
+bundled CLIP byte-pair merges (config/clip), so no network access or model
+download is needed. The BPE follows the original CLIP SimpleTokenizer
+(MIT License, Copyright (c) 2021 OpenAI).
+
+CLIP splits text on whitespace and word/punctuation boundaries before
+applying BPE, so the token count of "a, b" is count("a,") + count("b"). That
+lets the generator precompute the count of every option once, with and
+without the trailing separator, and budget prompts without tokenizing them.
+"""
+import re
+import gzip
+import html
+from functools import lru_cache
+from pathlib import Path
+
+VOCAB_FILE = Path(__file__).parent / 'config' / 'clip' / 'bpe_simple_vocab_16e6.txt.gz'
+
+# Tokens per CLIP chunk (77 minus the start and end tokens)
+CHUNK_TOKENS = 75
+
+# Separator a joined prompt puts after every part but the last (", " minus the space)
+SEPARATOR = ','
+
+# Same split as CLIP, with \p{L} / \p{N} spelled for the re module
+TOKEN_PATTERN = re.compile(
+    r"""'s|'t|'re|'ve|'m|'ll|'d|[^\W\d_]+|\d|(?:[^\s\w]|_)+""",
+    re.IGNORECASE
+)
+
+# Typographic quotes ftfy would fold before CLIP sees the text
+QUOTE_FIXES = str.maketrans({'\u2018': "'", '\u2019': "'", '\u201c': '"', '\u201d': '"'})
+
+@lru_cache()
+def bytes_to_unicode():
+    """Map utf-8 bytes to the printable characters the CLIP merges use"""
+    bs = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    cs = bs[:]
+    n = 0
+    for b in range(2**8):
+        if b not in bs:
+            bs.append(b)
+            cs.append(2**8 + n)
+            n += 1
+    return dict(zip(bs, [chr(c) for c in cs]))
+
+@lru_cache()
+def load_bpe_ranks(vocab_file=VOCAB_FILE):
+    """Load the merge ranks from the bundled vocabulary, or None if it is missing"""
+    try:
+        with gzip.open(vocab_file, 'rt', encoding='utf-8') as f:
+            merges = f.read().split('\n')
+    except OSError as e:
+        print(f"Warning: CLIP vocabulary not available ({e}), estimating token counts")
+        return None
+    merges = merges[1:49152 - 256 - 2 + 1]
+    return {tuple(merge.split()): rank for rank, merge in enumerate(merges)}
+
+def _bpe_length(word, ranks):
+    """Number of BPE pieces CLIP splits one pre-tokenized word into"""
+    symbols = list(word[:-1]) + [word[-1] + '</w>']
+    while len(symbols) > 1:
+        best = None
+        best_rank = None
+        for i in range(len(symbols) - 1):
+            rank = ranks.get((symbols[i], symbols[i + 1]))
+            if rank is not None and (best_rank is None or rank < best_rank):
+                best, best_rank = i, rank
+        if best is None:
+            break
+        first, second = symbols[best], symbols[best + 1]
+        # Merge every occurrence of the best pair, left to right
+        merged = []
+        i = 0
+        while i < len(symbols):
+            if i < len(symbols) - 1 and symbols[i] == first and symbols[i + 1] == second:
+                merged.append(first + second)
+                i += 2
+            else:
+                merged.append(symbols[i])
+                i += 1
+        symbols = merged
+    return len(symbols)
+
+@lru_cache(maxsize=65536)
+def word_token_count(word):
+    """Number of CLIP tokens for a single pre-tokenized word (cached)"""
+    ranks = load_bpe_ranks()
+    if ranks is None:
+        # Rough fallback: common words are one token, long ones ~5 chars each
+        return max(1, (len(word) + 3) // 5)
+    byte_encoder = bytes_to_unicode()
+    return _bpe_length(''.join(byte_encoder[b] for b in word.encode('utf-8')), ranks)
+
+def count_tokens(text):
+    """Number of CLIP tokens in text, excluding the start/end tokens"""
+    text = html.unescape(html.unescape(text)).translate(QUOTE_FIXES)
+    text = ' '.join(text.split()).lower()
+    return sum(word_token_count(word) for word in TOKEN_PATTERN.findall(text))
+
+# Counts per option string, shared by every category and profile
+_option_counts = {}
+
+def option_token_counts(options, suffix=''):
+    """Token count of every option (plus suffix) in a list, computed once per distinct string"""
+    counts = []
+    for option in options:
+        text = option + suffix
+        count = _option_counts.get(text)
+        if count is None:
+            count = _option_counts[text] = count_tokens(text)
+        counts.append(count)
+    return counts
+
+def chunks_for(tokens):
+    """Number of 75-token chunks A1111 encodes a prompt of this length in"""
+    return max(1, -(-tokens // CHUNK_TOKENS))
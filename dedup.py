@@ -0,0 +1,349 @@
+"""
+Duplicate filters for prompt generation.
+
+BloomFilter keeps a persistent, fixed-size record of every prompt a profile
+has emitted so later runs can skip or resample prompts that were already
+rendered. The bit array lives in a file that is memory mapped at startup,
+so the filter costs the same (capacity-derived) amount of memory whether it
+holds a thousand prompts or hundreds of millions.
+
+NearDuplicateFilter rejects prompts whose set of options is too similar to
+one already emitted in the run, e.g. the same subject, style and clothing
+under another light. Prompts are indexed by MinHash signatures in LSH
+bands, so a lookup only compares against the few prompts sharing a band.
+"""
+import math
+import mmap
+import random
+import struct
+import hashlib
+from collections import OrderedDict
+from pathlib import Path
+
+# Name of the history filter inside a profile directory
+HISTORY_FILENAME = 'history.bloom'
+
+class BloomFilter(object):
+    """Memory-mapped Bloom filter of prompt hashes.
+
+    The file starts with a small header (magic, version, bit count, hash
+    count, item count, capacity) followed by the bit array. Opening an
+    existing file keeps its original size and hash count; capacity and
+    fp_rate only apply when the file is created.
+    """
+    MAGIC = b'A1PBLOOM'
+    VERSION = 1
+    HEADER = struct.Struct('<8sIQIQQ')
+
+    def __init__(self, path, capacity=10000000, fp_rate=0.001):
+        self.path = Path(path)
+        if not self.path.exists() or self.path.stat().st_size < self.HEADER.size:
+            self._create(capacity, fp_rate)
+
+        self.file = open(self.path, 'r+b')
+        self.mm = mmap.mmap(self.file.fileno(), 0)
+        magic, version, self.num_bits, self.num_hashes, self.count, self.capacity = \
+            self.HEADER.unpack_from(self.mm, 0)
+        if magic != self.MAGIC or version != self.VERSION:
+            self._release()
+            raise ValueError(f"{self.path} is not a prompt history filter")
+        if len(self.mm) < self.HEADER.size + (self.num_bits + 7) // 8:
+            self._release()
+            raise ValueError(f"{self.path} is truncated")
+        self.offset = self.HEADER.size
+        self.warned = False
+
+    @staticmethod
+    def optimal_size(capacity, fp_rate):
+        """Bit and hash counts for a capacity at a target false-positive rate"""
+        if capacity <= 0 or not 0 < fp_rate < 1:
+            raise ValueError("Bloom filter needs a positive capacity and 0 < fp_rate < 1")
+        num_bits = int(math.ceil(-capacity * math.log(fp_rate) / (math.log(2) ** 2)))
+        num_hashes = max(1, int(round(num_bits / capacity * math.log(2))))
+        return num_bits, num_hashes
+
+    def _create(self, capacity, fp_rate):
+        num_bits, num_hashes = self.optimal_size(capacity, fp_rate)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.VERSION, num_bits, num_hashes, 0, capacity))
+            # Sparse on most filesystems, so creating a large filter is instant
+            f.truncate(self.HEADER.size + (num_bits + 7) // 8)
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        num_bits = self.num_bits
+        return [(h1 + i * h2) % num_bits for i in range(self.num_hashes)]
+
+    def __contains__(self, key):
+        mm = self.mm
+        offset = self.offset
+        for pos in self._positions(key):
+            if not mm[offset + (pos >> 3)] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+    def add(self, key):
+        """Add a key, returning False if it was (probably) already present"""
+        mm = self.mm
+        offset = self.offset
+        new = False
+        for pos in self._positions(key):
+            index = offset + (pos >> 3)
+            byte = mm[index]
+            mask = 1 << (pos & 7)
+            if not byte & mask:
+                mm[index] = byte | mask
+                new = True
+        if new:
+            self.count += 1
+            if self.count > self.capacity and not self.warned:
+                print(f"Warning: {self.path} holds more than its capacity of {self.capacity} prompts; "
+                      "its false-positive rate is now above the configured rate")
+                self.warned = True
+        return new
+
+    def false_positive_rate(self):
+        """Current expected false-positive rate given the number of items added"""
+        return (1 - math.exp(-self.num_hashes * self.count / self.num_bits)) ** self.num_hashes
+
+    def flush(self):
+        """Write the item count and flush the bit array to disk"""
+        self.HEADER.pack_into(self.mm, 0, self.MAGIC, self.VERSION, self.num_bits,
+                              self.num_hashes, self.count, self.capacity)
+        self.mm.flush()
+
+    def _release(self):
+        self.mm.close()
+        self.file.close()
+        self.mm = None
+
+    def close(self):
+        if self.mm is not None:
+            self.flush()
+            self._release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class HistoryFilter(object):
+    """Sampler filter rejecting prompts already recorded in a BloomFilter"""
+    def __init__(self, bloom):
+        self.bloom = bloom
+
+    def seen(self, choice, prompt_text):
+        return prompt_text in self.bloom
+
+    def add(self, choice, prompt_text):
+        self.bloom.add(prompt_text)
+
+    def close(self):
+        self.bloom.close()
+
+# MinHash values per signature, split into LSH bands
+MINHASH_PERMUTATIONS = 32
+
+# Modulus of the MinHash permutations (a Mersenne prime)
+MINHASH_PRIME = (1 << 61) - 1
+
+# Bits of every MinHash value kept (the top ones, so minimums are unchanged)
+MINHASH_BITS = 32
+
+# Bits per value in a packed signature: the value, then a guard bit
+FIELD_BITS = MINHASH_BITS + 1
+
+# Most recent prompts kept per LSH bucket; a band of a small option set can
+# be a single common option, whose bucket would otherwise hold most prompts
+LSH_BUCKET_SIZE = 16
+
+def lsh_bands(threshold, num_perm=MINHASH_PERMUTATIONS):
+    """(bands, rows) that best split num_perm MinHash values for a Jaccard threshold.
+
+    Two sets of similarity s share at least one band with probability
+    1 - (1 - s^rows)^bands; this picks the split that misses the fewest
+    pairs above the threshold without sending too many pairs below it to
+    an exact comparison.
+    """
+    def area(bands, rows, low, high):
+        steps = 100
+        width = (high - low) / steps
+        return sum(1 - (1 - (low + (i + 0.5) * width) ** rows) ** bands for i in range(steps)) * width
+
+    best = None
+    for bands in range(1, num_perm + 1):
+        for rows in range(1, num_perm // bands + 1):
+            false_positives = area(bands, rows, 0.0, threshold)
+            false_negatives = (1 - threshold) - area(bands, rows, threshold, 1.0)
+            # Candidates are checked exactly, so a miss costs more than a comparison
+            error = 0.1 * false_positives + 0.9 * false_negatives
+            if best is None or error < best[0]:
+                best = (error, bands, rows)
+    return best[1], best[2]
+
+class NearDuplicateFilter(object):
+    """Sampler filter rejecting prompts close to one emitted earlier in the run.
+
+    A prompt is the set of (category, option) pairs of its choice, so a
+    category with several picks counts each pick and left-out categories
+    count nothing. Prompts are near duplicates when the Jaccard similarity
+    of their sets reaches threshold: with four categories, prompts that
+    differ in one share 3 of 5 options (0.6). column_categories gives the
+    category of every column of a choice.
+
+    Every pair's MinHash values are computed once and packed side by side
+    into one integer, FIELD_BITS per value, so a prompt's signature (their
+    element-wise minimum) takes a few integer operations per option instead
+    of a comparison per value, and each LSH band of it is a slice of bits
+    used as a key into that band's table. Prompts sharing a band are
+    compared exactly, so a prompt is never rejected below the threshold.
+    The filter is approximate the other way: pairs that share no band, or
+    whose earlier prompt has left a full bucket (each keeps its
+    LSH_BUCKET_SIZE latest prompts, so a lookup makes at most
+    bands * LSH_BUCKET_SIZE comparisons), are never compared, and now and
+    then a prompt right at the threshold gets through. Only the last window
+    prompts are remembered, which bounds memory (roughly 1 KB per prompt).
+    """
+    def __init__(self, column_categories, threshold=0.6, window=100000):
+        if not 0 < threshold <= 1:
+            raise ValueError("The near-duplicate threshold must be above 0 and at most 1")
+        if window <= 0:
+            raise ValueError("The near-duplicate window must hold at least one prompt")
+        self.column_categories = column_categories
+        # A (category, option) pair is the integer option * stride + category
+        self.stride = max(column_categories, default=0) + 1
+        self.threshold = threshold
+        self.window = window
+        self.bands, self.rows = lsh_bands(threshold)
+        rng = random.Random(MINHASH_PRIME)
+        self.permutations = [(rng.randrange(1, MINHASH_PRIME), rng.randrange(MINHASH_PRIME))
+                             for _ in range(self.bands * self.rows)]
+        fields = range(self.bands * self.rows)
+        # Guard bit of every field, and the value bits of every field
+        self.guards = sum(1 << (field * FIELD_BITS + MINHASH_BITS) for field in fields)
+        self.values = sum(((1 << MINHASH_BITS) - 1) << (field * FIELD_BITS) for field in fields)
+        self.band_bits = self.rows * FIELD_BITS
+        self.band_mask = (1 << self.band_bits) - 1
+        self.pair_hashes = {}
+        # One {band key: {prompt number: option set}} table per band, oldest first
+        self.tables = [{} for _ in range(self.bands)]
+        # prompt number -> (option set, band keys), oldest first
+        self.recent = OrderedDict()
+        self.number = 0
+        self.last = None
+
+    def _pair_hash(self, pair):
+        """Packed MinHash values of a pair"""
+        option, cat = divmod(pair, self.stride)
+        digest = hashlib.blake2b(repr((cat, option)).encode(), digest_size=8).digest()
+        value = int.from_bytes(digest, 'little')
+        shift = MINHASH_PRIME.bit_length() - MINHASH_BITS
+        packed = 0
+        for field, (a, b) in enumerate(self.permutations):
+            packed |= ((a * value + b) % MINHASH_PRIME >> shift) << (field * FIELD_BITS)
+        return packed
+
+    def _signature(self, choice):
+        """(option set, band keys) of a choice, cached for the add() that follows seen()"""
+        if self.last is not None and self.last[0] is choice:
+            return self.last[1]
+        column_categories = self.column_categories
+        stride = self.stride
+        pairs = {i * stride + column_categories[column] for column, i in enumerate(choice) if i >= 0}
+        keys = self._band_keys(pairs) if pairs else None
+        self.last = (choice, (pairs, keys))
+        return pairs, keys
+
+    def _band_keys(self, pairs):
+        """LSH band keys of a non-empty option set"""
+        pair_hashes = self.pair_hashes
+        guards = self.guards
+        signature = None
+        for pair in pairs:
+            packed = pair_hashes.get(pair)
+            if packed is None:
+                packed = pair_hashes[pair] = self._pair_hash(pair)
+            if signature is None:
+                signature = packed
+                continue
+            # Field-wise minimum: a field's guard bit survives the
+            # subtraction where the signature's value is the larger one
+            larger = ((signature | guards) - packed) & guards
+            take = larger - (larger >> MINHASH_BITS)
+            signature = (packed & take) | (signature & ~take)
+        band_bits = self.band_bits
+        band_mask = self.band_mask
+        return [signature >> (band * band_bits) & band_mask for band in range(self.bands)]
+
+    def seen(self, choice, prompt_text):
+        pairs, keys = self._signature(choice)
+        if keys is None:
+            return False
+        # A prompt can share several bands with this one; compare it once
+        candidates = {}
+        for table, key in zip(self.tables, keys):
+            bucket = table.get(key)
+            if bucket:
+                candidates.update(bucket)
+        threshold = self.threshold
+        size = len(pairs)
+        for other in candidates.values():
+            # Jaccard |a & b| / |a | b| >= threshold, without building the union
+            if len(pairs & other) * (1 + threshold) >= threshold * (size + len(other)):
+                return True
+        return False
+
+    def add(self, choice, prompt_text):
+        pairs, keys = self._signature(choice)
+        if keys is not None:
+            self._insert(pairs, keys)
+
+    def _insert(self, pairs, keys):
+        number = self.number
+        self.number += 1
+        for table, key in zip(self.tables, keys):
+            bucket = table.get(key)
+            if bucket is None:
+                table[key] = {number: pairs}
+            else:
+                bucket[number] = pairs
+                if len(bucket) > LSH_BUCKET_SIZE:
+                    del bucket[next(iter(bucket))]
+        self.recent[number] = (pairs, keys)
+        if len(self.recent) > self.window:
+            oldest, (_, old_keys) = self.recent.popitem(last=False)
+            for table, key in zip(self.tables, old_keys):
+                bucket = table.get(key)
+                # Buckets fill in prompt order, so the oldest prompt comes first
+                if bucket and next(iter(bucket)) == oldest:
+                    if len(bucket) == 1:
+                        del table[key]
+                    else:
+                        del bucket[oldest]
+
+    def get_state(self):
+        """The prompts in the window, as JSON-friendly data for a checkpoint"""
+        return {'number': self.number, 'recent': [sorted(pairs) for pairs, _ in self.recent.values()]}
+
+    def set_state(self, state):
+        """Rebuild the window saved by get_state(), so a resumed run rejects the same prompts"""
+        self.tables = [{} for _ in range(self.bands)]
+        self.recent = OrderedDict()
+        self.last = None
+        self.number = state['number'] - len(state['recent'])
+        for pairs in state['recent']:
+            pairs = set(pairs)
+            self._insert(pairs, self._band_keys(pairs))
+
+def history_path(profile_path=None, config_dir=None):
+    """Location of the persistent history filter of a profile"""
+    if profile_path:
+        return Path(profile_path) / HISTORY_FILENAME
+    return Path(config_dir) / HISTORY_FILENAME
@@ -0,0 +1,1665 @@
+"""
+Headless prompt generation engine for the A1111 Prompt Generator.
+
+Everything in here works without Tk so it can be shared by the GUI and by
+command line / batch tooling.
+"""
+import os
+import re
+import sys
+import math
+import random
+import hashlib
+import json
+import threading
+import itertools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+from clip_tokens import option_token_counts, SEPARATOR
+from dedup import BloomFilter, HistoryFilter, NearDuplicateFilter, history_path
+from rules import compile_rules
+from templates import CompiledTemplate, compile_template
+from manifest import RunManifest, MANIFEST_FILENAME, MANIFEST_MODES, file_sha256, PromptRecorder
+from checkpoint import Checkpointer, read_checkpoint, truncate_files
+from choices import ChoiceRecorder, ReplaySampler, read_header, iter_choices
+
+# Get the base directory (where this script is located)
+BASE_DIR = Path(__file__).parent
+DATA_DIR = BASE_DIR / 'config' / 'data'
+CONFIG_DIR = BASE_DIR / 'config'
+PROFILES_DIR = BASE_DIR / 'config' / 'profiles'
+OUTPUT_DIR = BASE_DIR / 'output'
+
+# List of categories and their corresponding filenames
+categories = [
+    "Subject",
+    "FacialExpression",
+    "Clothing",
+    "Situation",
+    "Medium",
+    "Style",
+    "AdditionalDetails",
+    "Color",
+    "Lighting",
+    "Remarks"
+]
+
+# Default settings
+DEFAULT_SETTINGS = {
+    'STEPS': '20',
+    'CFG_SCALE': '9.5',
+    'SAMPLER': 'DPM++ 2M Karras',
+    'WIDTH': '1024',
+    'HEIGHT': '1024',
+    'SEED': '-1',
+    'SEED_MODE': 'fixed',
+    'SWEEP': 'grid',
+    'SWEEP_ORDER': '',
+    'SAMPLING': 'random',
+    'TOKEN_BUDGET': '0',
+    'TOKEN_BUDGET_MODE': 'drop',
+    'DEDUP_HISTORY': 'off',
+    'DEDUP_MODE': 'skip',
+    'DEDUP_CAPACITY': '10000000',
+    'DEDUP_FP_RATE': '0.001',
+    'NEAR_DEDUP': 'off',
+    'NEAR_DEDUP_THRESHOLD': '0.6',
+    'NEAR_DEDUP_WINDOW': '100000',
+    'CHUNK_SIZE': '0',
+    'MANIFEST': 'runs',
+    'NORMALIZE_OPTIONS': 'off',
+    'CHECKPOINT_EVERY': '100000',
+    'SAVE_CHOICES': 'off',
+    'OUTPUT_FORMAT': 'a1111'
+}
+
+# Settings that end up on every generated line and may hold sweep values
+SWEEP_KEYS = ['STEPS', 'CFG_SCALE', 'SAMPLER', 'WIDTH', 'HEIGHT', 'SEED']
+
+# Shorthands accepted in SWEEP_ORDER
+SWEEP_ORDER_ALIASES = {
+    'SIZE': ['WIDTH', 'HEIGHT'],
+    'CFG': ['CFG_SCALE'],
+}
+
+# Per-prompt seed strategies (SEED_MODE)
+SEED_MODES = ['fixed', 'sequential', 'hash', 'random']
+
+# Largest seed A1111 accepts
+MAX_SEED = 2**32 - 1
+
+# How options are drawn from each category (SAMPLING)
+SAMPLING_MODES = ['random', 'balanced']
+
+# How over-budget prompts are handled (TOKEN_BUDGET_MODE)
+TOKEN_BUDGET_MODES = ['drop', 'resample']
+
+# Redraws tried by TOKEN_BUDGET_MODE=resample before falling back to dropping
+MAX_RESAMPLE = 50
+
+# How prompts rejected by a duplicate filter are handled (DEDUP_MODE)
+DEDUP_MODES = ['skip', 'resample']
+
+# Option index of a category that was left out of a prompt
+OMITTED = -1
+
+# Prompts per independently seeded block of a sharded run
+SHARD_BLOCK = 1000
+
+# Default negative prompt (used if file not found)
+DEFAULT_NEGATIVE_PROMPT = 'deformed, ugly, creepy, mutation'
+
+def find_case_insensitive_file(base_name, data_dir=None):
+    """Find a file with case-insensitive matching in the data directory.
+
+    The profile's data directory is searched first, then the shared
+    config/data directory.
+    """
+    search_dirs = [Path(data_dir)] if data_dir else []
+    if DATA_DIR not in search_dirs:
+        search_dirs.append(DATA_DIR)
+
+    target_lower = base_name.lower()
+    for directory in search_dirs:
+        if not os.path.exists(directory):
+            continue
+        for file in os.listdir(directory):
+            if file.lower() == target_lower:
+                return directory / file
+    return None
+
+def parse_options(text):
+    """The options in a category file's text: its lines, stripped, without empty ones"""
+    return [line.strip() for line in text.split('\n') if line.strip()]
+
+def load_options(filename):
+    """Load lines from a txt file, stripping whitespace and ignoring empty lines"""
+    try:
+        with open(filename, "r", encoding="utf-8") as f:
+            return parse_options(f.read())
+    except FileNotFoundError:
+        print(f"Warning: File not found: {filename}")
+        return []
+    except Exception as e:
+        print(f"Error reading {filename}: {str(e)}")
+        return []
+
+def normalize_options(options):
+    """Collapse whitespace and merge options differing only in case or spacing.
+
+    The first spelling of an option is kept and strings are interned, so an
+    option used in several categories or profiles is stored once. Returns
+    (options, merged) with merged a list of (dropped, kept) pairs.
+    """
+    kept = {}
+    normalized = []
+    merged = []
+    for option in options:
+        text = sys.intern(' '.join(option.split()))
+        key = text.casefold()
+        if key in kept:
+            merged.append((option, kept[key]))
+            continue
+        kept[key] = text
+        normalized.append(text)
+    return normalized, merged
+
+def load_normalized_options(filename):
+    """load_options() followed by normalize_options(), reporting merged duplicates"""
+    return _normalized(load_options(filename), filename)
+
+def _normalized(options, filename):
+    options, merged = normalize_options(options)
+    if merged:
+        examples = "; ".join(f"'{dropped}'" if dropped == kept else f"'{dropped}' -> '{kept}'"
+                             for dropped, kept in merged[:3])
+        more = f" and {len(merged) - 3} more" if len(merged) > 3 else ""
+        print(f"{Path(filename).name}: merged {len(merged)} duplicate options ({examples}{more})")
+    return options
+
+class OptionCache(object):
+    """Thread-safe cache of loaded option files, shared between profiles.
+
+    Files are keyed by their resolved path, so a category file linked into
+    several profiles is read once, and re-read when its size or
+    modification time changes. The text of every file is kept with its
+    options, so a file read for display (read()) isn't read again for
+    generation (load()) or the other way round.
+    """
+    def __init__(self):
+        # path -> {'stamp', 'text', 'options': {normalize: options}}
+        self._entries = {}
+        self._lock = threading.Lock()
+        # One lock per file so concurrent loads of the same file read it once
+        self._file_locks = {}
+        self.hits = 0
+        self.misses = 0
+
+    def read(self, filename, normalize=False):
+        """(text, options) of a file; raises OSError if it can't be read"""
+        path = os.path.realpath(filename)
+        stat = os.stat(path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            file_lock = self._file_locks.setdefault(path, threading.Lock())
+        with file_lock:
+            entry = self._entries.get(path)
+            if entry and entry['stamp'] == stamp:
+                with self._lock:
+                    self.hits += 1
+            else:
+                with open(path, 'r', encoding='utf-8') as f:
+                    entry = {'stamp': stamp, 'text': f.read(), 'options': {}}
+                with self._lock:
+                    self._entries[path] = entry
+                    self.misses += 1
+            options = entry['options'].get(normalize)
+            if options is None:
+                options = parse_options(entry['text'])
+                if normalize:
+                    options = _normalized(options, path)
+                entry['options'][normalize] = options
+        return entry['text'], options
+
+    def load(self, filename, normalize=False):
+        """The options of a file ([] if it can't be read)"""
+        try:
+            return self.read(filename, normalize)[1]
+        except FileNotFoundError:
+            raise
+        except (OSError, ValueError) as e:
+            print(f"Error reading {filename}: {str(e)}")
+            return []
+
+    def peek(self, path, stamp):
+        """The text of a file if it is cached at this stamp, without touching the disk"""
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry and entry['stamp'] == stamp:
+            return entry['text']
+        return None
+
+    def discard(self, paths):
+        """Forget the files at these resolved paths, e.g. when their profile goes cold"""
+        with self._lock:
+            for path in paths:
+                self._entries.pop(path, None)
+
+def load_category_options(category_names, data_dir=None, cache=None, normalize=False):
+    """Load the option list of every category.
+
+    Raises FileNotFoundError if a category file is missing and ValueError if
+    it has no options, so callers can report the offending file. Pass an
+    OptionCache to share files between profiles. With normalize, options are
+    cleaned up by normalize_options() and merged duplicates are reported.
+    """
+    options = {}
+    for cat in category_names:
+        base_filename = f"{cat}.txt"
+        actual_filename = find_case_insensitive_file(base_filename, data_dir)
+        if not actual_filename:
+            raise FileNotFoundError(f"Could not find {base_filename}")
+        if cache:
+            options[cat] = cache.load(actual_filename, normalize)
+        elif normalize:
+            options[cat] = load_normalized_options(actual_filename)
+        else:
+            options[cat] = load_options(actual_filename)
+        if not options[cat]:
+            raise ValueError(f"No options found in {base_filename}")
+    return options
+
+def load_profile(profile_path):
+    """Load a profile's profile.json as a dict"""
+    with open(Path(profile_path) / 'profile.json', 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def category_file_info(category_names, data_dir=None):
+    """File and content hash of every category, as recorded in the run manifest"""
+    info = []
+    for cat in category_names:
+        filename = find_case_insensitive_file(f"{cat}.txt", data_dir)
+        info.append({
+            'category': cat,
+            'file': str(filename) if filename else None,
+            'sha256': file_sha256(filename) if filename else None,
+        })
+    return info
+
+def load_profile_tables(profile_path, cache=None, normalize=False):
+    """Load a profile from disk as (profile, options, negative_prompt)"""
+    profile = load_profile(profile_path)
+    data_dir = Path(profile_path) / 'data'
+    options = load_category_options(profile.get('categories', []), data_dir, cache, normalize)
+    return profile, options, load_negative_prompt(data_dir)
+
+# Memory the warm profiles of a ProfileCache may take up
+PROFILE_CACHE_BUDGET = 256 * 1024 * 1024
+
+def _file_stamp(path):
+    """(mtime, size) of a file or directory, None if it doesn't exist"""
+    try:
+        stat = os.stat(path)
+    except (OSError, TypeError):
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+def _table_size(options):
+    """Rough number of bytes an option list takes up"""
+    return sys.getsizeof(options) + sum(sys.getsizeof(option) for option in options)
+
+class ProfileCache(object):
+    """Bounded LRU of warm profiles: option tables and compiled rules.
+
+    get() returns a recently used profile without reading anything as long
+    as its profile.json, data folder, category files and NegativePrompt.txt
+    have the same modification times and sizes; when some have changed,
+    only those are read again. Least recently used profiles are dropped once
+    the tables take up more than budget bytes (the latest one is always
+    kept). Safe to share between threads.
+
+    With an option_cache the files are read through it, so tables are
+    shared with everything else using that cache; files of an evicted
+    profile that no warm profile uses are dropped from it too, so the
+    budget still bounds what stays in memory. With workers above 1 the
+    files of a profile are read concurrently.
+    """
+    def __init__(self, budget=PROFILE_CACHE_BUDGET, option_cache=None, workers=1):
+        self.budget = budget
+        self.option_cache = option_cache
+        # Only ever loads files, so get() can wait on it from any thread
+        self._pool = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _fresh(self, entry):
+        return all(_file_stamp(path) == stamp for path, stamp in entry['stamps'])
+
+    def _find_table(self, path, stamp, normalize):
+        """An already loaded, unchanged table of a file, from any warm profile"""
+        with self._lock:
+            entries = list(self._entries.items())
+        for (_, entry_normalize), entry in entries:
+            if entry_normalize == normalize and entry['tables'].get(path, (None,))[0] == stamp:
+                return entry['tables'][path][1]
+        return None
+
+    def _load_table(self, path, stamp, normalize):
+        if self.option_cache is not None:
+            return self.option_cache.load(path, normalize)
+        table = self._find_table(path, stamp, normalize)
+        if table is None:
+            table = load_normalized_options(path) if normalize else load_options(path)
+        return table
+
+    def files(self, profile_path, normalize=False):
+        """{category: (file, stamp)} of a warm profile whose files are unchanged, else None"""
+        if not profile_path:
+            return None
+        with self._lock:
+            entry = self._entries.get((os.path.realpath(profile_path), normalize))
+        if entry and self._fresh(entry):
+            return entry['files']
+        return None
+
+    def get(self, profile_path, normalize=False):
+        """The profile as (profile, options, negative_prompt, rules)"""
+        profile_path = Path(profile_path)
+        key = (os.path.realpath(profile_path), normalize)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry and self._fresh(entry):
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                self.hits += 1
+            return entry['profile']
+
+        data_dir = profile_path / 'data'
+        stamps = [(profile_path / 'profile.json', _file_stamp(profile_path / 'profile.json')),
+                  (data_dir, _file_stamp(data_dir))]
+        profile = load_profile(profile_path)
+        category_names = profile.get('categories', [])
+        files = {}
+        for cat in category_names:
+            filename = find_case_insensitive_file(f"{cat}.txt", data_dir)
+            if not filename:
+                raise FileNotFoundError(f"Could not find {cat}.txt")
+            path = os.path.realpath(filename)
+            files[cat] = (path, _file_stamp(path))
+        unique = list(dict.fromkeys(files.values()))
+        def load(file):
+            return self._load_table(file[0], file[1], normalize)
+        if self._pool and len(unique) > 1:
+            loaded = dict(zip(unique, self._pool.map(load, unique)))
+        else:
+            loaded = {file: load(file) for file in unique}
+        options = {}
+        tables = {}
+        for cat, (path, stamp) in files.items():
+            table = loaded[(path, stamp)]
+            if not table:
+                raise ValueError(f"No options found in {cat}.txt")
+            options[cat] = table
+            tables[path] = (stamp, table)
+            stamps.append((path, stamp))
+        negative_file = find_case_insensitive_file("NegativePrompt.txt", data_dir)
+        stamps.append((negative_file, _file_stamp(negative_file)))
+        rules = compile_rules(category_names, [options[cat] for cat in category_names], profile)
+
+        entry = {
+            'profile': (profile, options, load_negative_prompt(data_dir), rules),
+            'stamps': stamps,
+            'tables': tables,
+            'files': files,
+            # The option cache also keeps each file's text
+            'size': sum(_table_size(table) + (stamp[1] if self.option_cache is not None else 0)
+                        for stamp, table in tables.values()),
+        }
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old:
+                self.size -= old['size']
+            self._entries[key] = entry
+            self.size += entry['size']
+            self.misses += 1
+            cold = set()
+            while self.size > self.budget and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= evicted['size']
+                cold.update(evicted['tables'])
+            if cold:
+                for warm in self._entries.values():
+                    cold.difference_update(warm['tables'])
+        if cold and self.option_cache is not None:
+            self.option_cache.discard(cold)
+        return entry['profile']
+
+    def __len__(self):
+        return len(self._entries)
+
+def load_negative_prompt(data_dir=None):
+    """Load the negative prompt for a profile, falling back to the default"""
+    negative_prompt_file = find_case_insensitive_file("NegativePrompt.txt", data_dir)
+    if negative_prompt_file:
+        try:
+            with open(negative_prompt_file, 'r', encoding='utf-8') as nf:
+                return nf.read().strip()
+        except Exception:
+            pass
+    return DEFAULT_NEGATIVE_PROMPT
+
+def _lock_file(f):
+    """Take an exclusive lock on an open file (blocks until available)"""
+    if fcntl:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+
+def _unlock_file(f):
+    if fcntl:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+def _scan_run_numbers(output_dir, stem):
+    """Highest run number among existing outputs named like stem, stemN or stemN-001"""
+    pattern = re.compile(rf"^{re.escape(stem)}(\d*)(?:-\d+)?\.txt$")
+    highest = 0
+    for name in os.listdir(output_dir):
+        match = pattern.match(name)
+        if match:
+            highest = max(highest, int(match.group(1) or 1))
+    return highest
+
+def allocate_output_path(output_dir=OUTPUT_DIR, stem='generated_prompts'):
+    """Reserve the next run number in output_dir and return its output path.
+
+    Runs are numbered like before (stem.txt, stem2.txt, stem3.txt, ...). The
+    last number is kept in a .<stem>.counter file that is updated under an
+    exclusive file lock, so concurrent processes never get the same number
+    and the directory is only scanned once, when the counter is created.
+    The output file is created empty while the lock is held; numbers whose
+    file already exists (copied in, or written by an older version) are
+    skipped rather than overwritten.
+    """
+    output_dir = Path(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    with open(output_dir / f".{stem}.counter", 'a+', encoding='utf-8') as f:
+        _lock_file(f)
+        try:
+            f.seek(0)
+            text = f.read().strip()
+            last = int(text) if text.isdigit() else _scan_run_numbers(output_dir, stem)
+            number = last + 1
+            while True:
+                path = output_dir / (f"{stem}.txt" if number == 1 else f"{stem}{number}.txt")
+                try:
+                    os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                    break
+                except FileExistsError:
+                    number += 1
+            f.seek(0)
+            f.truncate()
+            f.write(str(number))
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            _unlock_file(f)
+    return path
+
+def load_settings():
+    """Load settings from config file or use defaults"""
+    settings = DEFAULT_SETTINGS.copy()
+    settings_file = CONFIG_DIR / 'settings.txt'
+
+    if settings_file.exists():
+        try:
+            with open(settings_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith('#'):
+                        key, value = line.split('=', 1)
+                        key = key.strip()
+                        value = value.strip()
+                        if key in settings:
+                            settings[key] = value
+            print(f"Loaded settings from {settings_file}")
+        except Exception as e:
+            print(f"Error loading settings: {e}. Using default settings.")
+
+    return settings
+
+def setting_enabled(settings, key):
+    """True if an on/off setting is switched on"""
+    return str(settings.get(key, '')).strip().lower() in ('on', 'true', 'yes', '1')
+
+def _decimals(text):
+    """Number of decimal places written in a numeric string"""
+    text = text.strip()
+    return len(text.split('.', 1)[1]) if '.' in text else 0
+
+def _parse_range(text):
+    """Split 'start..stop[:step]' into (start, step, decimals, number of values)"""
+    bounds, _, step = text.partition(':')
+    start, stop = bounds.split('..', 1)
+    step = step.strip() or '1'
+    decimals = max(_decimals(start), _decimals(stop), _decimals(step))
+    start, stop, step = float(start), float(stop), float(step)
+    if step <= 0:
+        raise ValueError(f"Range step must be positive: {text}")
+    if stop < start:
+        raise ValueError(f"Range end is before its start: {text}")
+    return start, step, decimals, int(math.floor((stop - start) / step + 1e-9)) + 1
+
+def _expand_range(text):
+    """Expand 'start..stop[:step]' into an inclusive list of values"""
+    start, step, decimals, count = _parse_range(text)
+    values = []
+    for i in range(count):
+        value = round(start + i * step, decimals)
+        values.append(f"{value:.{decimals}f}" if decimals else str(int(value)))
+    return values
+
+def parse_sweep_values(value):
+    """Expand a setting value into the list of values to sweep over.
+
+    A value can be a single value, a comma separated list ("5, 7, 9.5") or
+    an inclusive numeric range with an optional step ("20..40:10").
+    """
+    values = []
+    for item in str(value).split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if '..' in item:
+            values.extend(_expand_range(item))
+        else:
+            values.append(item)
+    if not values:
+        raise ValueError(f"Empty setting value: {value!r}")
+    return values
+
+def count_sweep_values(value):
+    """Number of values parse_sweep_values() returns, without expanding ranges"""
+    count = 0
+    for item in str(value).split(','):
+        item = item.strip()
+        if item:
+            count += _parse_range(item)[3] if '..' in item else 1
+    if not count:
+        raise ValueError(f"Empty setting value: {value!r}")
+    return count
+
+def parse_sweep_order(order):
+    """Turn a SWEEP_ORDER value such as "SAMPLER, SIZE" into setting keys"""
+    keys = []
+    for item in str(order or '').split(','):
+        item = item.strip().upper()
+        if not item or item == 'PROMPT':
+            continue
+        for key in SWEEP_ORDER_ALIASES.get(item, [item]):
+            if key not in SWEEP_KEYS:
+                raise ValueError(f"Unknown sweep order key: {item}")
+            if key not in keys:
+                keys.append(key)
+    return keys
+
+def build_settings_grid(settings, group_by=()):
+    """Build the sweep grid as an ordered list of (key, values) pairs.
+
+    Keys listed in group_by come first so that they change slowest when the
+    grid is walked in index order. The grid is never expanded; use
+    grid_size() and settings_at() to address individual combinations.
+    """
+    keys = list(group_by) + [key for key in SWEEP_KEYS if key not in group_by]
+    return [(key, parse_sweep_values(settings.get(key, DEFAULT_SETTINGS[key]))) for key in keys]
+
+def grid_size(grid):
+    """Number of settings combinations in a sweep grid"""
+    size = 1
+    for _, values in grid:
+        size *= len(values)
+    return size
+
+def settings_at(grid, index):
+    """Return the settings combination at a position of the grid"""
+    combo = {}
+    for key, values in reversed(grid):
+        index, pos = divmod(index, len(values))
+        combo[key] = values[pos]
+    return combo
+
+class PromptSampler(object):
+    """Draw prompts as tuples of option indices, one per category.
+
+    A category left out of a prompt holds OMITTED instead of an index. With a
+    token budget, the CLIP token count of every option is computed once up
+    front so each draw is checked with a few additions instead of
+    tokenizing the whole prompt.
+
+    filters are duplicate filters with seen(choice, text) and
+    add(choice, text) methods; prompts they reject are skipped or redrawn
+    depending on dedup_mode.
+
+    With balanced=True every category draws from a shuffle bag: a shuffled
+    copy of its option indices that is used up before it is reshuffled, so
+    every option appears once per pass through the category (as in a Latin
+    hypercube design) at O(1) amortized cost per draw.
+
+    rules is a rules.CompiledRules table; when it has restrictions, options
+    are drawn category by category from the options the earlier picks still
+    allow, backtracking only on dead ends, so valid prompts are produced
+    directly however many raw combinations the rules reject.
+
+    include and picks (see category_picks()) make categories optional or
+    give them several distinct options per prompt. The extra picks go in
+    extra columns after the categories' own, so a choice stays a flat
+    tuple of indices; the few categories involved are listed up front and
+    the rest of the draw is untouched. Extra picks are drawn uniformly
+    (without shuffle bags) from the options the rules allow alongside
+    everything already in the prompt; a category gets fewer picks if the
+    rules leave too few.
+
+    template is a templates.CompiledTemplate that renders the choices;
+    without one the options are joined with ", ".
+
+    In a sharded run block_base is the run's rng_seed and the generator is
+    restarted by start_block() every SHARD_BLOCK draws, so any block can be
+    drawn without drawing the ones before it.
+    """
+    def __init__(self, option_lists, rng=None, token_budget=0, budget_mode='drop', drop_order=None,
+                 filters=None, dedup_mode='skip', balanced=False, rules=None, template=None,
+                 include=None, picks=None):
+        self.option_lists = option_lists
+        self.sizes = [len(options) for options in option_lists]
+        include = include or [1.0] * len(option_lists)
+        picks = picks or [(1, 1)] * len(option_lists)
+        self.extra_columns = extra_columns(picks)
+        # One option list per column of a choice
+        self.column_lists = option_lists + [option_lists[cat_index] for cat_index in self.extra_columns]
+        self.category_columns = [[cat_index] for cat_index in range(len(option_lists))]
+        for column, cat_index in enumerate(self.extra_columns, len(option_lists)):
+            self.category_columns[cat_index].append(column)
+        self.padding = [OMITTED] * len(self.extra_columns)
+        # Category of every column of a choice
+        self.column_categories = list(range(len(option_lists))) + self.extra_columns
+        # (category, probability) of optional categories
+        self.inclusion = [(cat_index, p) for cat_index, p in enumerate(include) if p < 1]
+        # Pick plan of the categories not picked exactly once: (category, size,
+        # [(number of picks, extra columns to fill)] for every number it may get)
+        self.multi = []
+        for cat_index, (low, high) in enumerate(picks):
+            if (low, high) != (1, 1):
+                size = self.sizes[cat_index]
+                columns = self.category_columns[cat_index][1:]
+                counts = [(count, columns[:max(count - 1, 0)])
+                          for count in range(min(low, size), min(high, size) + 1)]
+                self.multi.append((cat_index, size, counts))
+        self.rng = rng or random.Random()
+        self.balanced = balanced
+        self.rules = rules if rules else None
+        # Picked once, so profiles without include or picks draw exactly as before
+        self._draw_choice = self._draw_all
+        if self.inclusion or self.multi:
+            self._draw_choice = self._draw_constrained_picks if self.rules else self._draw_picks
+        # Shuffle bags start empty and are filled on first use
+        self.bags = [list(range(size)) for size in self.sizes]
+        self.bag_positions = [size for size in self.sizes]
+        self.token_budget = token_budget
+        self.budget_mode = budget_mode
+        # Category positions in the order they are dropped to meet the budget
+        if drop_order is None:
+            drop_order = list(range(len(option_lists) - 1, 0, -1))
+        self.drop_order = drop_order
+        self.template = template or CompiledTemplate(self.column_lists, self.category_columns)
+        self.token_counts = None
+        self.joined_counts = None
+        if token_budget and self.template.parts is None:
+            texts = self.template.texts
+            self.token_counts = [option_token_counts(options) for options in texts]
+            # Counts with the separator that follows every part but the last
+            self.joined_counts = [option_token_counts(options, SEPARATOR) for options in texts]
+        self.block_base = None
+        self.filters = filters or []
+        self.dedup_mode = dedup_mode
+        # Number of drawn prompts rejected as duplicates
+        self.rejected = 0
+
+    def _draw_all(self):
+        if self.rules:
+            return self._draw_constrained()
+        if self.balanced:
+            return [self._draw_from_bag(cat_index) for cat_index in range(len(self.sizes))]
+        randrange = self.rng.randrange
+        return [randrange(size) for size in self.sizes]
+
+    def _draw_picks(self):
+        """Draw a choice with its optional categories and extra picks"""
+        choice = self._draw_all()
+        random_ = self.rng.random
+        for cat_index, probability in self.inclusion:
+            if random_() >= probability:
+                choice[cat_index] = OMITTED
+        choice.extend(self.padding)
+        for cat_index, size, counts in self.multi:
+            first = choice[cat_index]
+            if first == OMITTED:
+                continue
+            count, columns = counts[int(random_() * len(counts))]
+            if not count:
+                choice[cat_index] = OMITTED
+                continue
+            # Further distinct options, redrawing the rare repeats
+            taken = [first]
+            for column in columns:
+                other = int(random_() * size)
+                while other in taken:
+                    other = int(random_() * size)
+                taken.append(other)
+                choice[column] = other
+        return choice
+
+    def _draw_constrained_picks(self):
+        """Draw a choice whose extra picks also obey the rules"""
+        choice = self._draw_all()
+        random_ = self.rng.random
+        for cat_index, probability in self.inclusion:
+            if random_() >= probability:
+                choice[cat_index] = OMITTED
+        choice.extend(self.padding)
+        rules = self.rules
+        chosen = None
+        for cat_index, size, counts in self.multi:
+            first = choice[cat_index]
+            if first == OMITTED:
+                continue
+            count, columns = counts[int(random_() * len(counts))]
+            if not count:
+                choice[cat_index] = OMITTED
+                continue
+            if columns and chosen is None:
+                chosen = [(self.column_categories[column], i) for column, i in enumerate(choice) if i != OMITTED]
+            taken = [first]
+            for column in columns:
+                # Only options every option already in the prompt allows
+                candidates = [i for i in rules.indices(cat_index, rules.allowed(cat_index, chosen))
+                              if i not in taken]
+                if not candidates:
+                    break
+                other = candidates[int(random_() * len(candidates))]
+                chosen.append((cat_index, other))
+                taken.append(other)
+                choice[column] = other
+        return choice
+
+    def _draw_from_bag(self, cat_index):
+        pos = self.bag_positions[cat_index]
+        bag = self.bags[cat_index]
+        if pos >= len(bag):
+            self.rng.shuffle(bag)
+            pos = 0
+        self.bag_positions[cat_index] = pos + 1
+        return bag[pos]
+
+    def _draw_constrained(self):
+        choice = [0] * len(self.sizes)
+        if not self._assign(0, self.rules.full_masks, choice):
+            raise ValueError("The profile's rules leave no valid combination of options")
+        return choice
+
+    def _assign(self, cat_index, allowed, choice):
+        if cat_index == len(choice):
+            return True
+        mask = allowed[cat_index]
+        for option in self._candidate_order(cat_index, mask):
+            restricted = self.rules.restrict(cat_index, option, allowed)
+            if restricted is not None:
+                choice[cat_index] = option
+                if self._assign(cat_index + 1, restricted, choice):
+                    return True
+        return False
+
+    def _candidate_order(self, cat_index, mask):
+        """Yield one random allowed option, then the others only if it leads to a dead end"""
+        candidates = self.rules.indices(cat_index, mask)
+        first = None
+        if self.balanced:
+            first = self._draw_from_bag(cat_index)
+            if not mask >> first & 1:
+                first = None
+        if first is None:
+            first = candidates[self.rng.randrange(len(candidates))]
+        yield first
+        rest = [option for option in candidates if option != first]
+        self.rng.shuffle(rest)
+        yield from rest
+
+    def choice_tokens(self, choice):
+        """CLIP token count of the prompt a choice renders to"""
+        if self.template.parts is not None:
+            return self.template.token_count(choice)
+        tokens = 0
+        last = None
+        for column in self.template.order:
+            i = choice[column]
+            if i != OMITTED:
+                tokens += self.joined_counts[column][i]
+                last = column
+        if last is None:
+            return 0
+        # The last part is not followed by a separator
+        i = choice[last]
+        return tokens - self.joined_counts[last][i] + self.token_counts[last][i]
+
+    def draw(self):
+        """Draw the option indices of one prompt"""
+        choice = self._draw_choice()
+        if not self.token_budget:
+            return tuple(choice)
+
+        budget = self.token_budget
+        tokens = self.choice_tokens(choice)
+        if self.budget_mode == 'resample':
+            for _ in range(MAX_RESAMPLE):
+                if tokens <= budget:
+                    return tuple(choice)
+                choice = self._draw_choice()
+                tokens = self.choice_tokens(choice)
+
+        # Leave out low-priority categories until the prompt fits
+        for cat_index in self.drop_order:
+            if tokens <= budget:
+                break
+            for column in self.category_columns[cat_index]:
+                choice[column] = OMITTED
+            tokens = self.choice_tokens(choice)
+        return tuple(choice)
+
+    def render(self, choice):
+        """Turn a tuple of option indices into the prompt text"""
+        return self.template.render(choice)
+
+    def next_prompt(self):
+        """Draw one prompt that passes the duplicate filters.
+
+        Returns (choice, prompt_text), or None if the prompt was rejected
+        (DEDUP_MODE=skip, or resample ran out of attempts).
+        """
+        attempts = MAX_RESAMPLE if self.dedup_mode == 'resample' else 1
+        for _ in range(attempts):
+            choice = self.draw()
+            prompt_text = self.render(choice)
+            if not any(f.seen(choice, prompt_text) for f in self.filters):
+                for f in self.filters:
+                    f.add(choice, prompt_text)
+                return choice, prompt_text
+            self.rejected += 1
+        return None
+
+    def start_block(self, index):
+        """Restart the generator and shuffle bags for block index of a sharded run"""
+        self.rng.seed(block_seed(self.block_base, index))
+        self.bags = [list(range(size)) for size in self.sizes]
+        self.bag_positions = list(self.sizes)
+
+    def get_state(self):
+        """Everything that decides the sampler's next draws, as JSON-friendly data"""
+        version, internal, gauss = self.rng.getstate()
+        return {
+            'rng': [version, list(internal), gauss],
+            'bags': [list(bag) for bag in self.bags] if self.balanced else None,
+            'bag_positions': list(self.bag_positions),
+            'rejected': self.rejected,
+            # Filters that remember the run so far (the near-duplicate window)
+            'filters': [f.get_state() for f in self.filters if hasattr(f, 'get_state')],
+        }
+
+    def set_state(self, state):
+        """Restore a state saved by get_state()"""
+        version, internal, gauss = state['rng']
+        self.rng.setstate((version, tuple(internal), gauss))
+        if state['bags'] is not None:
+            self.bags = [list(bag) for bag in state['bags']]
+        self.bag_positions = list(state['bag_positions'])
+        self.rejected = state['rejected']
+        # Checkpoints of older versions have no filter states
+        stateful = [f for f in self.filters if hasattr(f, 'set_state')]
+        for f, filter_state in zip(stateful, state.get('filters', [])):
+            f.set_state(filter_state)
+
+    def close(self):
+        """Close the duplicate filters, saving persistent ones"""
+        for f in self.filters:
+            if hasattr(f, 'close'):
+                f.close()
+
+def category_picks(category_names, profile):
+    """Inclusion probability and (fewest, most) picks of every category.
+
+    A profile's "include" maps a category to the probability that it
+    appears in a prompt at all, and "picks" to the number of distinct
+    options it contributes: a number, or [fewest, most] for a number drawn
+    uniformly from that range, e.g. {"Color": [0, 3]}.
+    """
+    profile = profile or {}
+    include = [1.0] * len(category_names)
+    picks = [(1, 1)] * len(category_names)
+    for cat, value in (profile.get('include') or {}).items():
+        if cat not in category_names:
+            print(f"Warning: inclusion probability given for unknown category '{cat}'")
+            continue
+        try:
+            probability = float(value)
+        except (TypeError, ValueError):
+            probability = None
+        if probability is None or not 0 <= probability <= 1:
+            raise ValueError(f"The inclusion probability of {cat} must be between 0 and 1")
+        include[category_names.index(cat)] = probability
+    for cat, value in (profile.get('picks') or {}).items():
+        if cat not in category_names:
+            print(f"Warning: picks given for unknown category '{cat}'")
+            continue
+        if isinstance(value, int) and not isinstance(value, bool):
+            value = [value, value]
+        if not (isinstance(value, list) and len(value) == 2
+                and all(isinstance(v, int) and not isinstance(v, bool) for v in value)
+                and 0 <= value[0] <= value[1]):
+            raise ValueError(f"The picks of {cat} must be a number or a [fewest, most] range")
+        low, high = value
+        picks[category_names.index(cat)] = (low, high)
+    return include, picks
+
+def extra_columns(picks):
+    """Category of every extra column a choice needs for categories with several picks"""
+    return [cat_index for cat_index, (_, high) in enumerate(picks) for _ in range(high - 1)]
+
+def make_sampler(category_names, options, settings, profile=None, rng=None, profile_path=None, rules=None):
+    """Build the PromptSampler for a profile's categories and run settings.
+
+    The profile's "rules" and "tags" (see rules.py), its "template" and
+    "prefixes" (see templates.py) and its "include" and "picks" (see
+    category_picks()) are compiled here, once per run. Its
+    optional "token_drop_order" lists the categories to leave out first
+    when a prompt is over TOKEN_BUDGET; by default categories are dropped
+    from the end of the list and the first one is always kept.
+
+    With DEDUP_HISTORY=on the profile's persistent history filter is opened
+    (or created at DEDUP_CAPACITY / DEDUP_FP_RATE); call the sampler's
+    close() when the run is done to save it. NEAR_DEDUP=on adds a
+    NearDuplicateFilter over the last NEAR_DEDUP_WINDOW prompts. Pass rules already compiled
+    (e.g. by a ProfileCache) to skip compiling them again.
+    """
+    profile = profile or {}
+    token_budget = int(settings.get('TOKEN_BUDGET', 0) or 0)
+    if token_budget < 0:
+        raise ValueError("TOKEN_BUDGET must be 0 (off) or a positive token count")
+    budget_mode = str(settings.get('TOKEN_BUDGET_MODE', 'drop')).strip().lower() or 'drop'
+    if budget_mode not in TOKEN_BUDGET_MODES:
+        raise ValueError(f"Unknown token budget mode: {budget_mode}")
+
+    drop_order = None
+    if profile.get('token_drop_order'):
+        drop_order = [category_names.index(cat) for cat in profile['token_drop_order'] if cat in category_names]
+
+    dedup_mode = str(settings.get('DEDUP_MODE', 'skip')).strip().lower() or 'skip'
+    if dedup_mode not in DEDUP_MODES:
+        raise ValueError(f"Unknown dedup mode: {dedup_mode}")
+    sampling = str(settings.get('SAMPLING', 'random')).strip().lower() or 'random'
+    if sampling not in SAMPLING_MODES:
+        raise ValueError(f"Unknown sampling mode: {sampling}")
+
+    filters = []
+    if setting_enabled(settings, 'DEDUP_HISTORY'):
+        bloom = BloomFilter(history_path(profile_path, CONFIG_DIR),
+                            int(settings.get('DEDUP_CAPACITY', DEFAULT_SETTINGS['DEDUP_CAPACITY'])),
+                            float(settings.get('DEDUP_FP_RATE', DEFAULT_SETTINGS['DEDUP_FP_RATE'])))
+        filters.append(HistoryFilter(bloom))
+
+    option_lists = [options[cat] for cat in category_names]
+    if rules is None:
+        rules = compile_rules(category_names, option_lists, profile)
+    include, picks = category_picks(category_names, profile)
+    columns = extra_columns(picks)
+    template = compile_template(category_names, option_lists, profile, columns)
+    if setting_enabled(settings, 'NEAR_DEDUP'):
+        filters.append(NearDuplicateFilter(
+            list(range(len(category_names))) + columns,
+            float(settings.get('NEAR_DEDUP_THRESHOLD', DEFAULT_SETTINGS['NEAR_DEDUP_THRESHOLD'])),
+            int(settings.get('NEAR_DEDUP_WINDOW', DEFAULT_SETTINGS['NEAR_DEDUP_WINDOW']))))
+    return PromptSampler(option_lists, rng, token_budget, budget_mode, drop_order, filters, dedup_mode,
+                         balanced=(sampling == 'balanced'), rules=rules, template=template,
+                         include=include, picks=picks)
+
+def resolve_seed_plan(settings, rng):
+    """Work out the seed strategy of a run as a (mode, base_seed) pair.
+
+    SEED_MODE=fixed keeps SEED (or its sweep values) on every line. The other
+    modes treat SEED as the base/master seed of the run; -1 draws one from
+    rng so that it can still be recorded and replayed.
+    """
+    mode = str(settings.get('SEED_MODE', 'fixed')).strip().lower() or 'fixed'
+    if mode not in SEED_MODES:
+        raise ValueError(f"Unknown seed mode: {mode}")
+    if mode == 'fixed':
+        return mode, None
+
+    values = parse_sweep_values(settings.get('SEED', DEFAULT_SETTINGS['SEED']))
+    if len(values) != 1:
+        raise ValueError(f"SEED must be a single base seed with SEED_MODE={mode}")
+    base = int(values[0])
+    if base < 0:
+        base = rng.randrange(MAX_SEED + 1)
+    return mode, base
+
+def hash_seed(base, index):
+    """Stable seed for a prompt derived from the base seed and prompt index"""
+    digest = hashlib.blake2b(f"{base}:{index}".encode(), digest_size=4).digest()
+    return int.from_bytes(digest, 'big')
+
+def block_seed(rng_seed, index):
+    """Generator seed of one block of a sharded run"""
+    digest = hashlib.blake2b(f"{rng_seed}:block:{index}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+def check_shard(shard, count, settings):
+    """Check a (start, end) prompt range of a sharded run"""
+    start, end = shard
+    if count is None:
+        raise ValueError("A sharded run needs a prompt count")
+    if not 0 <= start <= end <= count:
+        raise ValueError(f"Shard {start}:{end} is outside the run's {count} prompts")
+    if start % SHARD_BLOCK:
+        raise ValueError(f"Shards must start at a multiple of {SHARD_BLOCK} prompts")
+    if parse_sweep_order(settings.get('SWEEP_ORDER', '')):
+        raise ValueError("SWEEP_ORDER can't be used in a sharded run")
+
+class RunProgress(object):
+    """Position of a run's job stream, kept up to date for checkpoints.
+
+    draws counts sampler draws (rejected prompts included), prompts the
+    prompts emitted and lines the jobs yielded. at_boundary is True while
+    the job just yielded is the last one of its prompt: only then does the
+    sampler's state match the jobs handed out so far.
+    """
+    def __init__(self, draws=0, prompts=0, lines=0):
+        self.draws = draws
+        self.prompts = prompts
+        self.lines = lines
+        self.at_boundary = False
+
+def iter_seeds(seed_plan, start=0):
+    """Yield the seed of every prompt of a run in prompt order (None when fixed)"""
+    mode, base = seed_plan
+    index = start
+    if mode == 'random':
+        # Own generator so the seeds don't depend on how many option draws happen
+        seed_rng = random.Random(base)
+        for _ in range(start):
+            seed_rng.randrange(MAX_SEED + 1)
+    while True:
+        if mode == 'sequential':
+            yield (base + index) % (MAX_SEED + 1)
+        elif mode == 'hash':
+            yield hash_seed(base, index)
+        elif mode == 'random':
+            yield seed_rng.randrange(MAX_SEED + 1)
+        else:
+            yield None
+        index += 1
+
+def iter_prompts(sampler, count, seed_plan=('fixed', None), progress=None):
+    """Lazily yield (prompt_text, seed) for up to count prompts (None: forever).
+
+    Prompts rejected by the sampler's duplicate filters are left out, so
+    fewer than count prompts may be produced. With a RunProgress, drawing
+    continues from its position and its draw count is kept up to date.
+    Sharded runs restart the sampler's generator at every block.
+    """
+    progress = progress or RunProgress()
+    seeds = iter_seeds(seed_plan, progress.prompts)
+    draws = range(progress.draws, count) if count is not None else itertools.count(progress.draws)
+    blocks = sampler.block_base is not None
+    for draw in draws:
+        if blocks and draw % SHARD_BLOCK == 0:
+            sampler.start_block(draw // SHARD_BLOCK)
+        prompt = sampler.next_prompt()
+        progress.draws = draw + 1
+        if prompt is not None:
+            yield prompt[1], next(seeds)
+
+def _job_settings(combo, seed):
+    """Apply a prompt's allocated seed to a settings combination"""
+    if seed is not None:
+        combo['SEED'] = str(seed)
+    return combo
+
+def iter_prompt_jobs(sampler, settings, count, seed_plan=None, progress=None):
+    """Lazily yield (prompt_text, settings) pairs for a generation run.
+
+    With SWEEP=grid every prompt is emitted once per settings combination
+    (count * grid size lines); with SWEEP=sample every prompt gets one
+    combination drawn at random. Keys named in SWEEP_ORDER are grouped so
+    consecutive jobs share them and A1111 does not have to switch sampler
+    or resolution between images. Grouped grid runs keep the count prompts
+    in memory (never the full grid); everything else is streamed.
+
+    seed_plan comes from resolve_seed_plan(); every prompt keeps its seed
+    across all of its settings combinations so sweeps stay comparable.
+
+    count=None generates prompts until the consumer stops; SWEEP_ORDER
+    grouping needs a known count and is ignored in sample mode.
+
+    progress (a RunProgress) resumes the jobs from a checkpointed position
+    and tracks the position as jobs are yielded. Grouped grid runs have no
+    prompt boundaries in their output, so they can't be checkpointed.
+    """
+    progress = progress or RunProgress()
+    rng = sampler.rng
+    seed_plan = seed_plan or resolve_seed_plan(settings, rng)
+    mode = str(settings.get('SWEEP', 'grid')).strip().lower() or 'grid'
+    if mode not in ('grid', 'sample'):
+        raise ValueError(f"Unknown sweep mode: {mode}")
+    group_by = parse_sweep_order(settings.get('SWEEP_ORDER', ''))
+    grid = build_settings_grid(settings, group_by)
+
+    total = grid_size(grid)
+    groups = grid_size(grid[:len(group_by)])
+    per_group = total // groups
+
+    if mode == 'sample':
+        for prompt_text, seed in iter_prompts(sampler, count, seed_plan, progress):
+            if count is None:
+                combo = settings_at(grid, rng.randrange(total))
+            else:
+                # Hand out the grouped keys in contiguous blocks, the rest at random
+                group = progress.prompts * groups // count
+                combo = settings_at(grid, group * per_group + rng.randrange(per_group))
+            progress.prompts += 1
+            progress.lines += 1
+            progress.at_boundary = True
+            yield prompt_text, _job_settings(combo, seed)
+        return
+
+    if groups == 1:
+        for prompt_text, seed in iter_prompts(sampler, count, seed_plan, progress):
+            progress.at_boundary = False
+            for index in range(total):
+                progress.lines += 1
+                if index == total - 1:
+                    progress.prompts += 1
+                    progress.at_boundary = True
+                yield prompt_text, _job_settings(settings_at(grid, index), seed)
+        return
+
+    if count is None:
+        raise ValueError("SWEEP_ORDER needs a prompt count; it can't group an endless run")
+    if progress.lines:
+        raise ValueError("Grid runs grouped by SWEEP_ORDER can't be resumed")
+    prompts = list(iter_prompts(sampler, count, seed_plan))
+    for group in range(groups):
+        for prompt_text, seed in prompts:
+            for index in range(group * per_group, (group + 1) * per_group):
+                yield prompt_text, _job_settings(settings_at(grid, index), seed)
+
+def format_prompt_line(prompt_text, negative_prompt, settings):
+    """Format one job in the A1111 "prompts from file" syntax"""
+    return (
+        f'--prompt "{prompt_text}" \
+--negative_prompt "{negative_prompt}" \
+--steps {settings["STEPS"]} --cfg_scale {settings["CFG_SCALE"]} \
+--sampler_name "{settings["SAMPLER"]}" --seed {settings["SEED"]} \
+--width {settings["WIDTH"]} --height {settings["HEIGHT"]}\n'
+    )
+
+def _json_number(value):
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return value
+    return int(number) if number.is_integer() else number
+
+def format_prompt_json(prompt_text, negative_prompt, settings):
+    """Format one job as a JSON line with the A1111 argument names"""
+    return json.dumps({
+        'prompt': prompt_text,
+        'negative_prompt': negative_prompt,
+        'steps': _json_number(settings['STEPS']),
+        'cfg_scale': _json_number(settings['CFG_SCALE']),
+        'sampler_name': settings['SAMPLER'],
+        'seed': _json_number(settings['SEED']),
+        'width': _json_number(settings['WIDTH']),
+        'height': _json_number(settings['HEIGHT']),
+    }, ensure_ascii=False) + '\n'
+
+def _csv_text(value):
+    return '"' + str(value).replace('"', '""') + '"'
+
+def format_prompt_csv(prompt_text, negative_prompt, settings):
+    """Format one job as a CSV row (columns as in CSV_HEADER)"""
+    return (f'{_csv_text(prompt_text)},{_csv_text(negative_prompt)},'
+            f'{settings["STEPS"]},{settings["CFG_SCALE"]},{_csv_text(settings["SAMPLER"])},'
+            f'{settings["SEED"]},{settings["WIDTH"]},{settings["HEIGHT"]}\n')
+
+CSV_HEADER = 'prompt,negative_prompt,steps,cfg_scale,sampler_name,seed,width,height\n'
+
+# Line formats of generated output
+OUTPUT_FORMATS = {
+    'a1111': format_prompt_line,
+    'jsonl': format_prompt_json,
+    'csv': format_prompt_csv,
+}
+
+# First line of every file of a format
+OUTPUT_HEADERS = {
+    'csv': CSV_HEADER,
+}
+
+# File extension of every format (a1111 keeps the output file's own)
+OUTPUT_EXTENSIONS = {
+    'jsonl': '.jsonl',
+    'csv': '.csv',
+}
+
+# Write buffer of every output file
+WRITE_BUFFER = 1 << 20
+
+def parse_output_formats(settings):
+    """The formats a run writes, from a comma separated OUTPUT_FORMAT"""
+    formats = []
+    for name in str(settings.get('OUTPUT_FORMAT', 'a1111')).split(','):
+        name = name.strip().lower()
+        if not name or name in formats:
+            continue
+        if name not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format: {name}")
+        formats.append(name)
+    return formats or ['a1111']
+
+def format_path(output_path, output_format):
+    """Path of a run's file in one output format, e.g. stem7.jsonl next to stem7.txt"""
+    output_path = Path(output_path)
+    extension = OUTPUT_EXTENSIONS.get(output_format)
+    return output_path.with_suffix(extension) if extension else output_path
+
+def seed_sidecar_path(output_path):
+    """Path of the seed sidecar written next to an output file"""
+    output_path = Path(output_path)
+    return output_path.with_name(f"{output_path.stem}.seeds.txt")
+
+def chunk_path(output_path, index):
+    """Path of the index-th (1-based) chunk of a chunked output, e.g. stem7-002.txt"""
+    output_path = Path(output_path)
+    return output_path.with_name(f"{output_path.stem}-{index:03d}{output_path.suffix}")
+
+def output_files(output_path, lines, chunk_size=0, output_formats=('a1111',)):
+    """Files write_prompt_file() produced for a run of the given line count"""
+    files = []
+    for output_format in output_formats:
+        path = format_path(output_path, output_format)
+        if not chunk_size:
+            files.append(path)
+        else:
+            chunks = max(1, -(-lines // chunk_size))
+            files.extend(chunk_path(path, index) for index in range(1, chunks + 1))
+    return files
+
+class _OutputSink(object):
+    """One output format of a run, with its own buffered file"""
+    def __init__(self, output_path, output_format, negative_prompt):
+        self.path = format_path(output_path, output_format)
+        self.format_line = OUTPUT_FORMATS[output_format]
+        self.header = OUTPUT_HEADERS.get(output_format)
+        self.negative_prompt = negative_prompt
+        self.file = None
+
+    def open(self, path, mode):
+        self.close()
+        self.file = open(path, mode, encoding="utf-8", buffering=WRITE_BUFFER)
+        if self.header and mode == "w":
+            self.file.write(self.header)
+
+    def write(self, prompt_text, job_settings):
+        self.file.write(self.format_line(prompt_text, self.negative_prompt, job_settings))
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+def write_prompt_file(output_path, jobs, negative_prompt, seed_plan=None, chunk_size=0,
+                      checkpointer=None, start_lines=0, output_formats=('a1111',)):
+    """Write (prompt_text, settings) jobs to output_path, returning the line count.
+
+    Every format in output_formats gets its own file, all written in the
+    same pass: a1111 to output_path itself, the others next to it with
+    their own extension (stem.jsonl, stem.csv). Each job is formatted once
+    per format.
+
+    With chunk_size, the run is split into files of at most chunk_size
+    lines named after output_path (stem-001.txt, stem-002.txt, ...).
+
+    Unless the seed mode is fixed, the seed of every line is also recorded
+    in a .seeds.txt sidecar together with the mode and base seed, so any
+    image of the run can be reproduced on its own.
+
+    A checkpoint.Checkpointer is given the open files whenever a checkpoint
+    is due. start_lines resumes a run: the files already hold that many
+    lines and are appended to.
+    """
+    written = start_lines
+    mode = "a" if start_lines else "w"
+    sinks = [_OutputSink(output_path, output_format, negative_prompt) for output_format in output_formats]
+    paths = [sink.path for sink in sinks]
+    if len(set(paths)) != len(paths):
+        raise ValueError(f"{Path(output_path).name} would be overwritten by another output format")
+    sidecar = None
+    try:
+        if seed_plan and seed_plan[0] != 'fixed':
+            sidecar = open(seed_sidecar_path(output_path), mode, encoding="utf-8")
+            if not start_lines:
+                sidecar.write(f"# Seeds for {Path(output_path).name}, one per line\n")
+                sidecar.write(f"# SEED_MODE={seed_plan[0]}\n# BASE_SEED={seed_plan[1]}\n")
+        for sink in sinks:
+            if not chunk_size:
+                sink.open(sink.path, mode)
+            elif written % chunk_size:
+                # Resuming in the middle of a chunk
+                sink.open(chunk_path(sink.path, written // chunk_size + 1), "a")
+        for prompt_text, job_settings in jobs:
+            if chunk_size and written % chunk_size == 0:
+                for sink in sinks:
+                    sink.open(chunk_path(sink.path, written // chunk_size + 1), "w")
+            for sink in sinks:
+                sink.write(prompt_text, job_settings)
+            if sidecar:
+                sidecar.write(f"{job_settings['SEED']}\n")
+            written += 1
+            if checkpointer and checkpointer.due(written):
+                open_files = [sink.file for sink in sinks] + ([sidecar] if sidecar else [])
+                checkpointer.save(written, open_files)
+        if chunk_size and not written:
+            # Empty chunked run: still leave its first (empty) chunk behind
+            for sink in sinks:
+                sink.open(chunk_path(sink.path, 1), "w")
+    finally:
+        for sink in sinks:
+            sink.close()
+        if sidecar:
+            sidecar.close()
+    return written
+
+def stream_prompts(stream, jobs, negative_prompt, output_format='a1111'):
+    """Write (prompt_text, settings) jobs to an open text stream as they are made.
+
+    Every line is flushed straight away, so a pipe's reader sees prompts
+    immediately and a slow reader blocks the write, holding generation back
+    instead of letting output pile up in memory. A reader that closes the
+    pipe ends the stream normally. Returns the number of lines written.
+    """
+    format_line = OUTPUT_FORMATS[output_format]
+    written = 0
+    try:
+        if output_format in OUTPUT_HEADERS:
+            stream.write(OUTPUT_HEADERS[output_format])
+        for prompt_text, job_settings in jobs:
+            stream.write(format_line(prompt_text, negative_prompt, job_settings))
+            stream.flush()
+            written += 1
+    except BrokenPipeError:
+        # Point the descriptor at devnull so the final flush at exit doesn't fail again
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, stream.fileno())
+        os.close(devnull)
+    finally:
+        if hasattr(jobs, 'close'):
+            jobs.close()
+    return written
+
+def run_generation(category_names, options, settings, count, output_path, negative_prompt,
+                   profile=None, profile_path=None, rng_seed=None, manifest_path=None,
+                   stream=None, output_format='a1111', rules=None, shard=None):
+    """Generate count prompts for a profile into output_path.
+
+    With stream (an open text stream such as sys.stdout or a FIFO) the jobs
+    are streamed to it in output_format instead, output_path only names the
+    stream in the manifest, and count may be None to keep going until the
+    reader closes the stream.
+
+    The run's random generator is seeded with rng_seed (drawn at random if
+    not given) so the run can be reproduced. Unless MANIFEST=off the run is
+    recorded in the output folder's manifest (manifest_path overrides its
+    location). Runs written to a file are checkpointed every
+    CHECKPOINT_EVERY lines so resume_generation() can finish them. rules
+    are the profile's compiled rules if they are at hand (see ProfileCache).
+
+    shard is a (start, end) range of the count prompts: only those are
+    generated, and every SHARD_BLOCK prompts are drawn from their own
+    generator seeded from rng_seed, so machines given the same rng_seed
+    and disjoint ranges produce the slices of one run (see shards.py).
+    Sharded runs number seeds by position in the whole run.
+
+    Returns a summary dict of the run (output, files written, lines,
+    prompts, rejected duplicates, the seeds used and the manifest run id).
+    """
+    if rng_seed is None:
+        rng_seed = random.randrange(2**63)
+    rng = random.Random(rng_seed)
+    chunk_size = int(settings.get('CHUNK_SIZE', 0) or 0)
+    if chunk_size < 0:
+        raise ValueError("CHUNK_SIZE must be 0 (off) or a positive line count")
+    checkpoint_every = int(settings.get('CHECKPOINT_EVERY', 0) or 0)
+    if checkpoint_every < 0:
+        raise ValueError("CHECKPOINT_EVERY must be 0 (off) or a positive line count")
+    manifest_mode = str(settings.get('MANIFEST', 'runs')).strip().lower() or 'runs'
+    if manifest_mode not in MANIFEST_MODES:
+        raise ValueError(f"Unknown manifest mode: {manifest_mode}")
+    parse_output_formats(settings)
+    if shard is not None:
+        check_shard(shard, count, settings)
+
+    data_dir = Path(profile_path) / 'data' if profile_path else None
+    run = {
+        'output': os.path.abspath(output_path) if stream is None else str(output_path),
+        'count': count,
+        'rng_seed': rng_seed,
+        'settings': dict(settings),
+        'profile': profile or {},
+        'profile_path': str(profile_path) if profile_path else None,
+        'categories': list(category_names),
+        'category_files': category_file_info(category_names, data_dir),
+        'negative_prompt': negative_prompt,
+        'manifest': str(manifest_path or OUTPUT_DIR / MANIFEST_FILENAME),
+        'run_id': None,
+        'shard': list(shard) if shard is not None else None,
+    }
+    sampler = make_sampler(category_names, options, settings, profile, rng, profile_path, rules)
+    try:
+        run['seed_plan'] = list(resolve_seed_plan(settings, rng))
+        if manifest_mode != 'off':
+            with RunManifest(run['manifest']) as manifest:
+                run['run_id'] = manifest.begin_run(
+                    Path(profile_path).name if profile_path else None, profile_path, run['output'], count,
+                    rng_seed, run['seed_plan'], settings, run['category_files'])
+        progress = RunProgress()
+        if shard is not None:
+            sampler.block_base = rng_seed
+            progress = RunProgress(shard[0], shard[0])
+        return _execute_run(run, sampler, progress, stream, output_format)
+    finally:
+        sampler.close()
+
+def resume_generation(checkpoint_file, cache=None):
+    """Finish an interrupted run from its checkpoint sidecar.
+
+    The output files are cut back to the checkpoint and the run continues
+    from the saved sampler state, so the result is the same as if it had
+    never stopped. Raises ValueError if the category files changed since.
+    With DEDUP_HISTORY=on, prompts drawn after the checkpoint are already in
+    the history filter, so the resumed part may differ.
+    """
+    state = read_checkpoint(checkpoint_file)
+    profile_path = state['profile_path']
+    data_dir = Path(profile_path) / 'data' if profile_path else None
+    category_names = state['categories']
+    settings = state['settings']
+    if category_file_info(category_names, data_dir) != state['category_files']:
+        raise ValueError("The category files changed since the run started, so it can't be resumed exactly")
+    options = load_category_options(category_names, data_dir, cache,
+                                    setting_enabled(settings, 'NORMALIZE_OPTIONS'))
+
+    run = {key: value for key, value in state.items()
+           if key not in ('version', 'lines', 'draws', 'prompts', 'sizes', 'sampler')}
+    sampler = make_sampler(category_names, options, settings, state['profile'],
+                           random.Random(state['rng_seed']), profile_path)
+    try:
+        sampler.set_state(state['sampler'])
+        if run.get('shard'):
+            sampler.block_base = run['rng_seed']
+        truncate_files(state['sizes'])
+        progress = RunProgress(state['draws'], state['prompts'], state['lines'])
+        return _execute_run(run, sampler, progress)
+    finally:
+        sampler.close()
+
+def _execute_run(run, sampler, progress, stream=None, output_format='a1111'):
+    """Produce the jobs of a run from progress onwards and write them out"""
+    settings = run['settings']
+    seed_plan = tuple(run['seed_plan'])
+    chunk_size = int(settings.get('CHUNK_SIZE', 0) or 0)
+    checkpoint_every = int(settings.get('CHECKPOINT_EVERY', 0) or 0)
+    manifest_mode = str(settings.get('MANIFEST', 'runs')).strip().lower() or 'runs'
+    output_formats = parse_output_formats(settings)
+    start_lines = progress.lines
+    # Sharded runs stop at the end of their range
+    end = run['shard'][1] if run.get('shard') else run['count']
+
+    manifest = None
+    recorder = None
+    choice_recorder = None
+    run_id = run['run_id']
+    try:
+        if stream is None and setting_enabled(settings, 'SAVE_CHOICES'):
+            header = {key: run[key] for key in ('output', 'count', 'rng_seed', 'seed_plan', 'settings', 'profile',
+                                                'profile_path', 'categories', 'category_files', 'shard')}
+            # Closed with the sampler's other filters
+            choice_recorder = ChoiceRecorder(run['output'], [len(options) for options in sampler.column_lists],
+                                             header, append=bool(start_lines))
+            sampler.filters.append(choice_recorder)
+        jobs = iter_prompt_jobs(sampler, settings, end, seed_plan, progress)
+        if run_id is not None:
+            manifest = RunManifest(run['manifest'])
+            if start_lines:
+                manifest.truncate_prompts(run_id, start_lines)
+            if manifest_mode == 'prompts':
+                recorder = PromptRecorder(manifest, run_id, jobs, start_lines)
+                jobs = iter(recorder)
+        if stream is not None:
+            lines = stream_prompts(stream, jobs, run['negative_prompt'], output_format)
+            files = []
+        else:
+            checkpointer = None
+            if checkpoint_every and end is not None:
+                def before_checkpoint():
+                    for pending in (recorder, choice_recorder):
+                        if pending:
+                            pending.flush()
+                checkpointer = Checkpointer(run['output'], checkpoint_every, run, sampler, progress,
+                                            before_checkpoint, [choice_recorder.file] if choice_recorder else [])
+            lines = write_prompt_file(run['output'], jobs, run['negative_prompt'], seed_plan, chunk_size,
+                                      checkpointer, start_lines, output_formats)
+            files = [str(path) for path in output_files(run['output'], lines, chunk_size, output_formats)]
+            if checkpointer:
+                checkpointer.finish()
+        if manifest:
+            manifest.finish_run(run_id, lines, files)
+    finally:
+        if manifest:
+            manifest.close()
+    return {
+        'output': run['output'],
+        'files': files,
+        'formats': output_formats if stream is None else [output_format],
+        'lines': lines,
+        # Prompts written, leaving out the ones the duplicate filters rejected
+        'prompts': progress.prompts - (run['shard'][0] if run.get('shard') else 0),
+        'rejected': sampler.rejected,
+        'rng_seed': run['rng_seed'],
+        'seed_mode': seed_plan[0],
+        'base_seed': seed_plan[1],
+        'run_id': run_id,
+        'shard': run.get('shard'),
+        'category_files': run['category_files'],
+    }
+
+def rerender_run(choices_file, output_path, overrides=None, cache=None):
+    """Write a new prompts file from a run's saved choice matrix.
+
+    Every prompt keeps its recorded combination of option indices and its
+    seed, but is rendered from the current category files and the run's
+    settings updated with overrides, so fixing a typo or changing CFG keeps
+    the same prompts. With SWEEP=sample the settings combinations are drawn
+    again. Returns a summary dict like run_generation() plus the categories
+    whose files changed since the run.
+    """
+    header_path, header = read_header(choices_file)
+    matrix_path = header_path.with_name(header_path.name[:-len('.json')])
+    overrides = overrides or {}
+    settings = dict(header['settings'], **overrides)
+    chunk_size = int(settings.get('CHUNK_SIZE', 0) or 0)
+    output_formats = parse_output_formats(settings)
+
+    profile_path = header['profile_path']
+    data_dir = Path(profile_path) / 'data' if profile_path else None
+    category_names = header['categories']
+    options = load_category_options(category_names, data_dir, cache,
+                                    setting_enabled(settings, 'NORMALIZE_OPTIONS'))
+    profile = header.get('profile')
+    columns = extra_columns(category_picks(category_names, profile)[1])
+    option_lists = [options[cat] for cat in category_names]
+    column_lists = option_lists + [option_lists[cat_index] for cat_index in columns]
+    column_names = category_names + [category_names[cat_index] for cat_index in columns]
+    if len(column_lists) != len(header['sizes']):
+        raise ValueError("The choices file doesn't match the run's profile")
+    for cat, options_now, size in zip(column_names, column_lists, header['sizes']):
+        if len(options_now) < size:
+            raise ValueError(f"{cat}.txt has fewer options than when the run was made "
+                             f"({len(options_now)} < {size}), so its choices no longer line up")
+    changed = [now['category'] for now, then in zip(category_file_info(category_names, data_dir),
+                                                    header['category_files'])
+               if now['sha256'] != then['sha256']]
+
+    row_bytes = header['itemsize'] * len(column_lists)
+    count = os.path.getsize(matrix_path) // row_bytes if row_bytes else 0
+    rng = random.Random(header['rng_seed'])
+    template = compile_template(category_names, option_lists, profile, columns)
+    replay = ReplaySampler(column_lists, iter_choices(matrix_path, header), rng, template.render)
+    if 'SEED' in overrides or 'SEED_MODE' in overrides:
+        seed_plan = resolve_seed_plan(settings, rng)
+    else:
+        seed_plan = tuple(header['seed_plan'])
+    start = header['shard'][0] if header.get('shard') else 0
+    jobs = iter_prompt_jobs(replay, settings, start + count, seed_plan, RunProgress(start, start))
+    lines = write_prompt_file(output_path, jobs, load_negative_prompt(data_dir), seed_plan, chunk_size,
+                              output_formats=output_formats)
+    return {
+        'output': str(output_path),
+        'files': [str(path) for path in output_files(output_path, lines, chunk_size, output_formats)],
+        'formats': output_formats,
+        'lines': lines,
+        'prompts': count,
+        'changed': changed,
+    }
@@ -2,9 +2,15 @@
 """
 Launcher script for A1111 Prompt Generator
 This ensures the application finds all its resources correctly.
+
+Without arguments it opens the window; with arguments it runs the command
+line interface (e.g. "A1111-Prompt-Generator batch Portraits --count 500")
+without ever loading the GUI. --startup-check loads the GUI modules and
+exits, which build.py uses to time how fast a build starts.
 """
 import os
 import sys
+import multiprocessing
 from pathlib import Path
 
 def add_app_to_path():
@@ -19,6 +25,9 @@ def ensure_directories():
     for dir_name in directories:
         os.makedirs(dir_name, exist_ok=True)
 
+# Keep in sync with build.STARTUP_CHECK_FLAG
+STARTUP_CHECK_FLAG = '--startup-check'
+
 def main():
     # Set up paths and environment
     add_app_to_path()
@@ -27,8 +36,17 @@ def main():
     # Set the working directory to the script's directory
     os.chdir(os.path.dirname(os.path.abspath(__file__)))
     
-    # Import and run the main application
+    # Lets batch worker processes of a frozen build start as workers, not as the app
+    multiprocessing.freeze_support()
+
+    # Import and run the main application (Tk and the GUI only when a window is needed)
     try:
+        if sys.argv[1:] == [STARTUP_CHECK_FLAG]:
+            import main
+            return
+        if len(sys.argv) > 1:
+            from cli import main as cli_main
+            sys.exit(cli_main())
         from main import main as app_main
         app_main()
     except ImportError as e:
@@ -1,4 +1,3 @@
-import random
 import os
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
@@ -9,6 +8,20 @@ import sys
 import platform
 import json
 import shutil
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from engine import (
+    BASE_DIR, DATA_DIR, CONFIG_DIR, PROFILES_DIR, OUTPUT_DIR, categories,
+    load_settings, load_category_options, load_negative_prompt,
+    load_profile, allocate_output_path, run_generation, SEED_MODES,
+    parse_sweep_values, parse_sweep_order, setting_enabled, OptionCache, ProfileCache, make_sampler,
+    find_case_insensitive_file, build_settings_grid, grid_size
+)
+from validate import ValidationCache, validate_profile, format_problems, has_errors
+
+# Category files read at the same time when a profile opens (they may be on a network share)
+PREFETCH_WORKERS = 8
 
 class ToolTip(object):
     """Create a tooltip for a given widget."""
@@ -73,108 +86,12 @@ class ToolTip(object):
 # Load environment variables
 load_dotenv()
 
-# Get the base directory (where this script is located)
-BASE_DIR = Path(__file__).parent
-DATA_DIR = BASE_DIR / 'config' / 'data'
-CONFIG_DIR = BASE_DIR / 'config'
-PROFILES_DIR = BASE_DIR / 'config' / 'profiles'
-
 # Ensure profiles directory exists
 os.makedirs(PROFILES_DIR, exist_ok=True)
 
 # Ensure data directory exists
 os.makedirs(DATA_DIR, exist_ok=True)
 
-# List of categories and their corresponding filenames
-categories = [
-    "Subject",
-    "FacialExpression",
-    "Clothing",
-    "Situation",
-    "Medium",
-    "Style",
-    "AdditionalDetails",
-    "Color",
-    "Lighting",
-    "Remarks"
-]
-
-# Default settings
-DEFAULT_SETTINGS = {
-    'STEPS': '20',
-    'CFG_SCALE': '9.5',
-    'SAMPLER': 'DPM++ 2M Karras',
-    'WIDTH': '1024',
-    'HEIGHT': '1024',
-    'SEED': '-1'
-}
-
-# Default negative prompt (used if file not found)
-DEFAULT_NEGATIVE_PROMPT = 'deformed, ugly, creepy, mutation'
-
-# Prompt template (order of parts)
-def build_prompt(parts):
-    # Filter out empty parts and join with ", "
-    return ", ".join(part for part in parts if part)
-
-def find_case_insensitive_file(base_name):
-    """Find a file with case-insensitive matching in the data directory"""
-    if not os.path.exists(DATA_DIR):
-        return None
-        
-    target_lower = base_name.lower()
-    for file in os.listdir(DATA_DIR):
-        if file.lower() == target_lower:
-            return DATA_DIR / file
-    return None
-
-def load_options(filename):
-    """Load lines from a txt file, stripping whitespace and ignoring empty lines"""
-    try:
-        with open(filename, "r", encoding="utf-8") as f:
-            return [line.strip() for line in f if line.strip()]
-    except FileNotFoundError:
-        print(f"Warning: File not found: {filename}")
-        return []
-    except Exception as e:
-        print(f"Error reading {filename}: {str(e)}")
-        return []
-
-def get_unique_filename(base_name):
-    """Return filename that does not clash with existing files."""
-    if not os.path.exists(base_name):
-        return base_name
-
-    name, ext = os.path.splitext(base_name)
-    counter = 2
-    while True:
-        candidate = f"{name}{counter}{ext}"
-        if not os.path.exists(candidate):
-            return candidate
-        counter += 1
-
-def load_settings():
-    """Load settings from config file or use defaults"""
-    settings = DEFAULT_SETTINGS.copy()
-    settings_file = CONFIG_DIR / 'settings.txt'
-    
-    if settings_file.exists():
-        try:
-            with open(settings_file, 'r', encoding='utf-8') as f:
-                for line in f:
-                    line = line.strip()
-                    if line and not line.startswith('#'):
-                        key, value = line.split('=', 1)
-                        key = key.strip()
-                        value = value.strip()
-                        if key in settings:
-                            settings[key] = value
-            print(f"Loaded settings from {settings_file}")
-        except Exception as e:
-            print(f"Error loading settings: {e}. Using default settings.")
-    
-    return settings
-
 def open_file_explorer(path):
     """Open file explorer at the given path"""
     try:
@@ -289,6 +206,150 @@ class CollapsibleFrame(ttk.Frame):
             except Exception as e:
                 messagebox.showerror("Error", f"Could not create file: {str(e)}")
 
+class PreviewPane(ttk.LabelFrame):
+    """Sample prompts drawn from the current categories.
+
+    Prompts are drawn on a worker thread from the in-memory option tables,
+    a page at a time: the first page when categories or files change (after
+    a short pause, so a burst of edits triggers one refresh), and further
+    pages only as the list is scrolled towards its end.
+    """
+    PAGE_SIZE = 50
+    # Milliseconds to wait after a change before refreshing
+    DELAY = 300
+    # Milliseconds between checks of the category files
+    WATCH_INTERVAL = 2000
+
+    def __init__(self, parent, app_instance):
+        ttk.LabelFrame.__init__(self, parent, text="Preview", padding=5)
+        self.app = app_instance
+        self.cache = app_instance.option_cache
+        self.results = queue.Queue()
+        # Bumped on every refresh so pages drawn for an old state are dropped
+        self.generation = 0
+        self.sampler = None
+        self.loading = False
+        self.pending = None
+        self.file_stamps = None
+
+        header = ttk.Frame(self)
+        header.pack(fill=tk.X)
+        self.status = tk.StringVar(value="")
+        ttk.Label(header, textvariable=self.status, anchor=tk.W).pack(side=tk.LEFT, fill=tk.X, expand=True)
+        refresh_btn = ttk.Button(header, text="⟳", width=3, command=self.refresh)
+        refresh_btn.pack(side=tk.RIGHT)
+        ToolTip(refresh_btn, "Draw a new sample of prompts")
+
+        list_frame = ttk.Frame(self)
+        list_frame.pack(fill=tk.BOTH, expand=True, pady=(5, 0))
+        self.scrollbar = ttk.Scrollbar(list_frame, orient=tk.VERTICAL)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.listbox = tk.Listbox(list_frame, height=8, activestyle='none', yscrollcommand=self.on_yview)
+        self.listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.scrollbar.config(command=self.listbox.yview)
+        self.listbox.bind("<MouseWheel>", self.on_scroll)
+        # X11 reports the wheel as buttons 4 (up) and 5 (down)
+        self.listbox.bind("<Button-4>", self.on_scroll)
+        self.listbox.bind("<Button-5>", self.on_scroll)
+
+        self.after(100, self.poll_results)
+        self.after(self.WATCH_INTERVAL, self.watch_files)
+
+    def schedule(self):
+        """Refresh once no further change has come in for DELAY milliseconds"""
+        if self.pending:
+            self.after_cancel(self.pending)
+        self.pending = self.after(self.DELAY, self.refresh)
+
+    def refresh(self):
+        self.pending = None
+        self.generation += 1
+        self.sampler = None
+        self.listbox.delete(0, tk.END)
+        self.file_stamps = self.category_stamps()
+        if not self.app.categories:
+            self.status.set("No categories selected")
+            return
+        self.status.set("Drawing sample prompts...")
+        self.start(self.draw_first_page, self.generation, list(self.app.categories), self.app.data_dir,
+                   self.app.preview_settings(), dict(self.app.profile_data), self.app.saved_profile_path())
+
+    def start(self, target, *args):
+        self.loading = True
+        threading.Thread(target=target, args=args, daemon=True).start()
+
+    def draw_page(self, sampler):
+        prompts = []
+        for _ in range(self.PAGE_SIZE):
+            prompt = sampler.next_prompt()
+            if prompt is not None:
+                prompts.append(prompt[1])
+        return prompts
+
+    def draw_first_page(self, generation, categories, data_dir, settings, profile, profile_path):
+        # Runs on a worker thread: only touches the queue, never the widgets
+        try:
+            normalize = setting_enabled(settings, 'NORMALIZE_OPTIONS')
+            tables = self.app.warm_tables(profile_path, categories, normalize)
+            if tables:
+                options, rules = tables
+            else:
+                options = load_category_options(categories, data_dir, self.cache, normalize)
+                rules = None
+            sampler = make_sampler(categories, options, settings, profile, rules=rules)
+            self.results.put((generation, sampler, self.draw_page(sampler), None))
+        except Exception as e:
+            self.results.put((generation, None, [], str(e)))
+
+    def draw_next_page(self, generation, sampler):
+        self.results.put((generation, sampler, self.draw_page(sampler), None))
+
+    def poll_results(self):
+        while True:
+            try:
+                generation, sampler, prompts, error = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if generation != self.generation:
+                continue
+            self.loading = False
+            if error:
+                self.status.set(f"No preview: {error}")
+                continue
+            self.sampler = sampler
+            for prompt in prompts:
+                self.listbox.insert(tk.END, prompt)
+            self.status.set(f"{self.listbox.size()} sample prompts (more load as you scroll)")
+        self.after(100, self.poll_results)
+
+    def on_yview(self, first, last):
+        self.scrollbar.set(first, last)
+        # Near the end of the list: draw the next page
+        if float(last) > 0.9 and self.sampler and not self.loading:
+            self.start(self.draw_next_page, self.generation, self.sampler)
+
+    def on_scroll(self, event):
+        up = event.num == 4 if event.num in (4, 5) else event.delta > 0
+        self.listbox.yview_scroll(-1 if up else 1, "units")
+        return "break"
+
+    def category_stamps(self):
+        stamps = []
+        for cat in self.app.categories:
+            filename = find_case_insensitive_file(f"{cat}.txt", self.app.data_dir)
+            try:
+                stat = os.stat(filename) if filename else None
+            except OSError:
+                stat = None
+            stamps.append((cat, stat.st_mtime_ns, stat.st_size) if stat else (cat, None, None))
+        return stamps
+
+    def watch_files(self):
+        """Refresh the preview when a category file is edited"""
+        if self.file_stamps is not None and self.category_stamps() != self.file_stamps:
+            self.schedule()
+        self.after(self.WATCH_INTERVAL, self.watch_files)
+
 class PromptGeneratorApp:
     def __init__(self, root):
         self.root = root
@@ -331,6 +392,20 @@ class PromptGeneratorApp:
         # Load settings and categories
         self.settings = load_settings()
         self.categories = categories.copy()
+        # Everything else stored in profile.json besides the category list
+        self.profile_data = {}
+        # Validation results of category files, by content hash
+        self.validation_cache = ValidationCache()
+        # Option tables shared by the preview and generation, warmed as a profile opens
+        self.option_cache = OptionCache()
+        # Recently opened profiles with their rules compiled, so switching back is instant;
+        # their files come from the option cache, read concurrently
+        self.profile_cache = ProfileCache(option_cache=self.option_cache, workers=PREFETCH_WORKERS)
+        # Category files are read on these threads; results come back through the queue
+        self.loader = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS)
+        self.loaded = queue.Queue()
+        # Bumped whenever the panels are rebuilt so reads for old panels are dropped
+        self.panels_generation = 0
         self.panels = {}
         
         # Create default profile if none exists
@@ -468,6 +543,10 @@ class PromptGeneratorApp:
         self.panels_frame = ttk.Frame(self.inner_frame)
         self.panels_frame.pack(fill=tk.BOTH, expand=True, pady=5, padx=5)
         
+        # Preview of sample prompts from the current categories
+        self.preview = PreviewPane(self.inner_frame, self)
+        self.preview.pack(fill=tk.BOTH, expand=True, pady=5, padx=10)
+        
         # Add a frame to fill remaining space at the bottom
         self.bottom_spacer = ttk.Frame(self.inner_frame, height=20)
         self.bottom_spacer.pack(fill=tk.X)
@@ -489,14 +568,14 @@ class PromptGeneratorApp:
         self.steps_var = tk.StringVar(value=str(self.settings.get('STEPS', '20')))
         steps_entry = ttk.Entry(row1, textvariable=self.steps_var, width=4)
         steps_entry.pack(side=tk.LEFT, padx=(0, 10))
-        steps_entry.config(validate='key', validatecommand=(self.root.register(self.validate_number), '%P'))
+        steps_entry.config(validate='key', validatecommand=(self.root.register(self.validate_sweep), '%P'))
         
         # CFG Scale
         ttk.Label(row1, text="CFG:").pack(side=tk.LEFT, padx=(0, 2))
         self.cfg_var = tk.StringVar(value=str(self.settings.get('CFG_SCALE', '7')))
         cfg_entry = ttk.Entry(row1, textvariable=self.cfg_var, width=4)
         cfg_entry.pack(side=tk.LEFT, padx=(0, 10))
-        cfg_entry.config(validate='key', validatecommand=(self.root.register(self.validate_float), '%P'))
+        cfg_entry.config(validate='key', validatecommand=(self.root.register(self.validate_sweep), '%P'))
         
         # Sampler
         ttk.Label(row1, text="Sampler:").pack(side=tk.LEFT, padx=(0, 2))
@@ -518,6 +597,22 @@ class PromptGeneratorApp:
         )
         self.sampler_combo.pack(side=tk.LEFT, padx=(0, 10))
         
+        # Token budget
+        ttk.Label(row1, text="Tokens:").pack(side=tk.LEFT, padx=(0, 2))
+        self.token_budget_var = tk.StringVar(value=str(self.settings.get('TOKEN_BUDGET', '0')))
+        token_entry = ttk.Entry(row1, textvariable=self.token_budget_var, width=4)
+        token_entry.pack(side=tk.LEFT, padx=(0, 10))
+        token_entry.config(validate='key', validatecommand=(self.root.register(self.validate_token_budget), '%P'))
+        ToolTip(token_entry, "CLIP token budget per prompt (75 = one A1111 chunk, 0 = off)")
+        
+        # Balanced sampling
+        self.balanced_var = tk.BooleanVar(value=self.settings.get('SAMPLING', 'random') == 'balanced')
+        balanced_check = ttk.Checkbutton(row1, text="Balanced", variable=self.balanced_var)
+        balanced_check.pack(side=tk.LEFT, padx=(0, 10))
+        ToolTip(balanced_check, "Use every option of a category before repeating any (shuffle bag)")
+        self.balanced_var.trace_add('write', lambda *args: self.preview.schedule())
+        self.token_budget_var.trace_add('write', lambda *args: self.preview.schedule())
+        
         # Second row - Width, Height, and Generate button
         row2 = ttk.Frame(settings_frame)
         row2.pack(fill=tk.X, pady=2)
@@ -527,21 +622,34 @@ class PromptGeneratorApp:
         self.width_var = tk.StringVar(value=str(self.settings.get('WIDTH', '512')))
         width_entry = ttk.Entry(row2, textvariable=self.width_var, width=4)
         width_entry.pack(side=tk.LEFT, padx=(0, 10))
-        width_entry.config(validate='key', validatecommand=(self.root.register(self.validate_number), '%P'))
+        width_entry.config(validate='key', validatecommand=(self.root.register(self.validate_sweep), '%P'))
         
         # Height
         ttk.Label(row2, text="H:").pack(side=tk.LEFT, padx=(0, 2))
         self.height_var = tk.StringVar(value=str(self.settings.get('HEIGHT', '768')))
         height_entry = ttk.Entry(row2, textvariable=self.height_var, width=4)
         height_entry.pack(side=tk.LEFT, padx=(0, 10))
-        height_entry.config(validate='key', validatecommand=(self.root.register(self.validate_number), '%P'))
+        height_entry.config(validate='key', validatecommand=(self.root.register(self.validate_sweep), '%P'))
         
         # Seed
         ttk.Label(row2, text="Seed:").pack(side=tk.LEFT, padx=(0, 2))
         self.seed_var = tk.StringVar(value=str(self.settings.get('SEED', '-1')))
         seed_entry = ttk.Entry(row2, textvariable=self.seed_var, width=8)
         seed_entry.pack(side=tk.LEFT, padx=(0, 10))
-        seed_entry.config(validate='key', validatecommand=(self.root.register(self.validate_seed), '%P'))
+        seed_entry.config(validate='key', validatecommand=(self.root.register(self.validate_sweep), '%P'))
+        ToolTip(seed_entry, "Seed, or base seed when a seed mode other than fixed is used (-1 for random)")
+        
+        # Seed mode
+        self.seed_mode_var = tk.StringVar(value=self.settings.get('SEED_MODE', 'fixed'))
+        seed_mode_combo = ttk.Combobox(
+            row2,
+            textvariable=self.seed_mode_var,
+            values=SEED_MODES,
+            state='readonly',
+            width=10
+        )
+        seed_mode_combo.pack(side=tk.LEFT, padx=(0, 10))
+        ToolTip(seed_mode_combo, "fixed: same seed on every line\nsequential: base seed + prompt number\nhash: hashed from base seed and prompt number\nrandom: drawn from the base seed\n\nNon-fixed seeds are recorded in a .seeds.txt file next to the output")
         
         # Right side - Generate button and prompts
         right_frame = ttk.Frame(action_frame)
@@ -590,6 +698,37 @@ class PromptGeneratorApp:
         
         # Initialize UI
         self.update_category_list()
+        self.root.after(50, self.poll_loaded)
+
+    def preview_settings(self):
+        """Settings for the preview: the current sampling controls, never the duplicate history"""
+        settings = dict(self.settings)
+        settings['SAMPLING'] = 'balanced' if self.balanced_var.get() else 'random'
+        settings['TOKEN_BUDGET'] = self.token_budget_var.get() or '0'
+        settings['DEDUP_HISTORY'] = 'off'
+        return settings
+
+    def saved_profile_path(self):
+        """The open profile's folder if the window matches what is saved in it, else None"""
+        if self.unsaved_changes:
+            return None
+        return self.current_profile_path
+
+    def warm_tables(self, profile_path, categories, normalize):
+        """(options, rules) of a saved profile from the profile cache, or None.
+
+        None when there is no saved profile or its categories are not the
+        ones given; callers then load the category files themselves.
+        """
+        if not profile_path:
+            return None
+        try:
+            profile, options, _, rules = self.profile_cache.get(profile_path, normalize)
+        except (OSError, ValueError):
+            return None
+        if profile.get('categories', []) != list(categories):
+            return None
+        return options, rules
 
     def update_title(self):
         title = "A1111 Prompt Generator"
@@ -617,6 +756,7 @@ class PromptGeneratorApp:
                 self.save_profile()
 
         self.categories = categories.copy()
+        self.profile_data = {}
         self.current_profile_path = None
         self.data_dir = DATA_DIR  # Reset to default data dir
         self.set_unsaved_changes(False)
@@ -636,7 +776,7 @@ class PromptGeneratorApp:
             os.makedirs(profile_path / 'data')
 
         # Save the category list to profile.json
-        profile_data = {'categories': self.categories}
+        profile_data = dict(self.profile_data, categories=self.categories)
         try:
             with open(profile_path / 'profile.json', 'w', encoding='utf-8') as f:
                 json.dump(profile_data, f, indent=4)
@@ -681,13 +821,16 @@ class PromptGeneratorApp:
             return
 
         try:
-            with open(profile_json, 'r', encoding='utf-8') as f:
-                profile_data = json.load(f)
+            profile_data = load_profile(profile_path)
             
             self.categories = profile_data.get('categories', [])
+            self.profile_data = profile_data
             self.current_profile_path = profile_path
             self.data_dir = profile_path / 'data'
             self.set_unsaved_changes(False)
+            # Warm the option tables and rules in the background (instant for a recent profile)
+            self.loader.submit(self.warm_tables, profile_path, self.categories,
+                               setting_enabled(self.settings, 'NORMALIZE_OPTIONS'))
             self.update_category_list()
             self.status_var.set(f"Profile '{profile_path.name}' loaded.")
             self.update_title()  # Update window title with profile name
@@ -769,13 +912,23 @@ class PromptGeneratorApp:
         
         # Update panels
         self.update_panels()
+        self.preview.schedule()
     
     def update_panels(self):
-        """Update the collapsible panels for each category"""
+        """Update the collapsible panels for each category.
+
+        The panels are created straight away. Files of a warm profile that
+        haven't changed are shown from the option cache; the others are read
+        concurrently on the loader threads and fill in their panels as they
+        arrive (see poll_loaded), warming the option cache on the way.
+        """
         # Clear existing panels
         for widget in self.panels_frame.winfo_children():
             widget.destroy()
         self.panels = {}
+        self.panels_generation += 1
+        normalize = setting_enabled(self.settings, 'NORMALIZE_OPTIONS')
+        files = self.profile_cache.files(self.saved_profile_path(), normalize) or {}
         
         # Create a panel for each category
         for cat in self.categories:
@@ -798,19 +951,12 @@ class PromptGeneratorApp:
             # Make text widget read-only
             text_widget.config(state=tk.NORMAL)
             
-            # Load content from file
-            file_path = self.data_dir / f"{cat}.txt"
-            if file_path.exists() or file_path.is_symlink():
-                try:
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        content = f.read()
-                    text_widget.insert(tk.END, content)
-                except Exception as e:
-                    text_widget.insert(tk.END, f"Error loading file: {str(e)}")
-            else:
-                text_widget.insert(tk.END, "[No content. Click the edit button to add content.]")
-            
+            # Content is filled in once the file has been read
+            content = self.option_cache.peek(*files[cat]) if cat in files else None
+            text_widget.insert(tk.END, "Loading..." if content is None else content)
             text_widget.config(state=tk.DISABLED)
+            if content is None:
+                self.loader.submit(self.read_category, self.panels_generation, cat, self.data_dir, normalize)
             
             # Store reference to the panel
             self.panels[cat] = {
@@ -818,6 +964,37 @@ class PromptGeneratorApp:
                 'text': text_widget
             }
     
+    def read_category(self, generation, cat, data_dir, normalize):
+        """Read a category file for its panel (runs on a loader thread, never touches widgets).
+
+        The one read also gives the option table the preview and generation use.
+        """
+        filename = find_case_insensitive_file(f"{cat}.txt", data_dir)
+        if filename:
+            try:
+                content = self.option_cache.read(filename, normalize)[0]
+            except Exception as e:
+                content = f"Error loading file: {str(e)}"
+        else:
+            content = "[No content. Click the edit button to add content.]"
+        self.loaded.put((generation, cat, content))
+    
+    def poll_loaded(self):
+        """Fill in the panels whose files have been read"""
+        while True:
+            try:
+                generation, cat, content = self.loaded.get_nowait()
+            except queue.Empty:
+                break
+            if generation != self.panels_generation or cat not in self.panels:
+                continue
+            text_widget = self.panels[cat]['text']
+            text_widget.config(state=tk.NORMAL)
+            text_widget.delete('1.0', tk.END)
+            text_widget.insert(tk.END, content)
+            text_widget.config(state=tk.DISABLED)
+        self.root.after(50, self.poll_loaded)
+    
     def on_category_select(self, event=None):
         """Handle category selection (double click)"""
         selected = self.cat_listbox.curselection()
@@ -998,7 +1175,27 @@ class PromptGeneratorApp:
             return int(value) == -1 or int(value) >= 0
         except ValueError:
             return False
-            
+
+    def validate_token_budget(self, value):
+        """Validate token budget input (0 disables the budget)"""
+        return value == "" or value.isdigit()
+
+    def validate_sweep(self, value):
+        """Allow numbers, comma separated lists and a..b:step ranges while typing"""
+        return all(c.isdigit() or c in "-.,: " for c in value)
+
+    def read_sweep_setting(self, key, var, validator, cast):
+        """Check a (possibly swept) numeric setting and return its normalized text"""
+        text = var.get().strip()
+        values = parse_sweep_values(text)
+        for value in values:
+            if not validator(value):
+                raise ValueError(f"Invalid {key} value: {value}")
+        # Keep single values normalized as before, sweep expressions verbatim
+        if len(values) == 1 and ',' not in text and '..' not in text:
+            return str(cast(float(values[0])))
+        return text
+
     def generate_prompts(self):
         """Generate prompts based on current settings"""
         # Get the number of prompts to generate
@@ -1008,12 +1205,17 @@ class PromptGeneratorApp:
                 raise ValueError("Number of prompts must be positive")
                 
             # Update settings from UI
-            self.settings['STEPS'] = str(int(float(self.steps_var.get())))
-            self.settings['CFG_SCALE'] = str(float(self.cfg_var.get()))
+            self.settings['STEPS'] = self.read_sweep_setting('STEPS', self.steps_var, self.validate_number, int)
+            self.settings['CFG_SCALE'] = self.read_sweep_setting('CFG_SCALE', self.cfg_var, self.validate_float, float)
             self.settings['SAMPLER'] = self.sampler_var.get()
-            self.settings['WIDTH'] = str(int(float(self.width_var.get())))
-            self.settings['HEIGHT'] = str(int(float(self.height_var.get())))
-            self.settings['SEED'] = str(int(float(self.seed_var.get())))
+            self.settings['WIDTH'] = self.read_sweep_setting('WIDTH', self.width_var, self.validate_number, int)
+            self.settings['HEIGHT'] = self.read_sweep_setting('HEIGHT', self.height_var, self.validate_number, int)
+            self.settings['SEED'] = self.read_sweep_setting('SEED', self.seed_var, self.validate_seed, int)
+            self.settings['SEED_MODE'] = self.seed_mode_var.get()
+            self.settings['TOKEN_BUDGET'] = str(int(self.token_budget_var.get() or 0))
+            self.settings['SAMPLING'] = 'balanced' if self.balanced_var.get() else 'random'
+            parse_sweep_values(self.settings['SAMPLER'])
+            parse_sweep_order(self.settings['SWEEP_ORDER'])
             
             # Save settings to file
             settings_file = os.path.join(CONFIG_DIR, "settings.txt")
@@ -1027,64 +1229,61 @@ class PromptGeneratorApp:
         if not self.categories:
             messagebox.showerror("Error", "No categories selected")
             return
+        
+        # Check every file the run reads before writing anything
+        problems = validate_profile(self.categories, self.data_dir, self.validation_cache)
+        self.validation_cache.save()
+        if has_errors(problems):
+            self.status_var.set("Category files have problems")
+            messagebox.showerror("Category File Problems", format_problems(problems, 30))
+            return
+        if problems and not messagebox.askyesno(
+                "Category File Warnings", format_problems(problems, 30) + "\n\nGenerate anyway?"):
+            self.status_var.set("Generation cancelled")
+            return
             
-        output_file = get_unique_filename("generated_prompts.txt")
-        output_dir = BASE_DIR / "output"
-        os.makedirs(output_dir, exist_ok=True)
-        output_path = output_dir / output_file
+        output_path = allocate_output_path(OUTPUT_DIR)
         
         # Load all category options
-        options = {}
-        for cat in self.categories:
-            base_filename = f"{cat}.txt"
-            actual_filename = find_case_insensitive_file(base_filename)
-            
-            if not actual_filename:
-                self.status_var.set(f"Error: Could not find {base_filename}")
-                messagebox.showerror("Error", f"Could not find {base_filename}")
-                return
-                
-            try:
-                options[cat] = load_options(actual_filename)
-                if not options[cat]:
-                    raise ValueError(f"No options found in {base_filename}")
-            except Exception as e:
-                self.status_var.set(f"Error loading {base_filename}")
-                messagebox.showerror("Error", f"Error loading {base_filename}: {str(e)}")
-                return
+        normalize = setting_enabled(self.settings, 'NORMALIZE_OPTIONS')
+        rules = None
+        try:
+            tables = self.warm_tables(self.saved_profile_path(), self.categories, normalize)
+            if tables:
+                options, rules = tables
+            else:
+                options = load_category_options(self.categories, self.data_dir, self.option_cache, normalize)
+        except Exception as e:
+            self.status_var.set(f"Error: {str(e)}")
+            messagebox.showerror("Error", str(e))
+            return
         
         # Generate prompts
-        num_prompts = 100  # Could be made configurable via UI
         try:
-            with open(output_path, "w", encoding="utf-8") as f:
-                for _ in range(num_prompts):
-                    parts = []
-                    for cat in self.categories:
-                        choice = random.choice(options[cat])
-                        parts.append(choice)
-                    
-                    prompt_text = build_prompt(parts)
-                    
-                    # Load negative prompt
-                    negative_prompt_file = DATA_DIR / "NegativePrompt.txt"
-                    try:
-                        with open(negative_prompt_file, 'r', encoding='utf-8') as nf:
-                            negative_prompt = nf.read().strip()
-                    except Exception:
-                        negative_prompt = DEFAULT_NEGATIVE_PROMPT
-                    
-                    # Write prompt in A1111 format
-                    line = (
-                        f'--prompt "{prompt_text}" \
---negative_prompt "{negative_prompt}" \
---steps {self.settings["STEPS"]} --cfg_scale {self.settings["CFG_SCALE"]} \
---sampler_name "{self.settings["SAMPLER"]}" --seed {self.settings["SEED"]} \
---width {self.settings["WIDTH"]} --height {self.settings["HEIGHT"]}\n'
-                    )
-                    f.write(line)
+            negative_prompt = load_negative_prompt(self.data_dir)
+            result = run_generation(self.categories, options, self.settings, num_prompts, output_path,
+                                    negative_prompt, self.profile_data, self.current_profile_path,
+                                    rules=rules)
+            num_lines = result['lines']
+            combinations = 1
+            if str(self.settings.get('SWEEP', 'grid')).strip().lower() != 'sample':
+                combinations = grid_size(build_settings_grid(self.settings))
             
-            self.status_var.set(f"Generated {num_prompts} prompts in {output_path}")
-            messagebox.showinfo("Success", f"Successfully generated {num_prompts} prompts!\n\nOutput file:\n{output_path}")
+            if combinations > 1:
+                summary = (f"{num_lines} jobs ({result['prompts']} prompts across "
+                           f"{combinations} settings combinations)")
+            else:
+                summary = f"{result['prompts']} prompts"
+            if result['rejected']:
+                summary += f" ({result['rejected']} duplicates skipped)"
+            chunks = len(result['files']) // len(result['formats'])
+            if chunks > 1:
+                summary += f" in {chunks} chunks"
+            if len(result['formats']) > 1:
+                summary += f" ({', '.join(result['formats'])})"
+            first_file = result['files'][0]
+            self.status_var.set(f"Generated {summary} in {first_file}")
+            messagebox.showinfo("Success", f"Successfully generated {summary}!\n\nOutput file:\n{first_file}")
             
         except Exception as e:
             self.status_var.set("Error generating prompts")
@@ -1092,9 +1291,8 @@ class PromptGeneratorApp:
     
     def open_output_folder(self):
         """Open the output folder in file explorer"""
-        output_dir = BASE_DIR / "output"
-        os.makedirs(output_dir, exist_ok=True)
-        open_file_explorer(output_dir)
+        os.makedirs(OUTPUT_DIR, exist_ok=True)
+        open_file_explorer(OUTPUT_DIR)
     
     def open_text_files(self):
         """Open the data folder with text files"""
@@ -0,0 +1,175 @@
+"""
+Run manifest for the output directory.
+
+Every generation run is recorded in output/manifest.sqlite: the profile,
+content hashes of its category files, the settings, the RNG seed, the
+prompt count and where the output went. With MANIFEST=prompts every written
+line is also indexed by a hash of its prompt, so "which run produced this
+prompt?" and "list runs of profile X last week" are index lookups instead
+of greps over the output folder.
+"""
+import json
+import sqlite3
+import hashlib
+from datetime import datetime
+from pathlib import Path
+
+MANIFEST_FILENAME = 'manifest.sqlite'
+
+# Manifest detail levels (MANIFEST setting)
+MANIFEST_MODES = ['off', 'runs', 'prompts']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    created TEXT NOT NULL,
+    finished TEXT,
+    profile TEXT,
+    profile_path TEXT,
+    output TEXT,
+    files TEXT,
+    count INTEGER,
+    lines INTEGER,
+    rng_seed TEXT,
+    seed_mode TEXT,
+    base_seed INTEGER,
+    settings TEXT,
+    category_files TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_profile_created ON runs (profile, created);
+CREATE INDEX IF NOT EXISTS runs_created ON runs (created);
+CREATE TABLE IF NOT EXISTS prompts (
+    hash INTEGER NOT NULL,
+    run_id INTEGER NOT NULL,
+    line INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS prompts_hash ON prompts (hash);
+"""
+
+# Prompt rows are inserted in batches of this size
+PROMPT_BATCH = 10000
+
+def prompt_hash(prompt_text):
+    """Signed 64-bit hash of a prompt, as stored in the prompts table"""
+    digest = hashlib.blake2b(prompt_text.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+def file_sha256(path):
+    """SHA-256 of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class RunManifest(object):
+    """SQLite index of generation runs (safe to share between processes)"""
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(self.path), timeout=60)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+
+    def begin_run(self, profile, profile_path, output, count, rng_seed, seed_plan, settings, category_files):
+        """Record the start of a run and return its id.
+
+        rng_seed is stored as text since batch seeds use the full 64 bits.
+        """
+        with self.db:
+            cursor = self.db.execute(
+                "INSERT INTO runs (created, profile, profile_path, output, count, rng_seed, seed_mode, "
+                "base_seed, settings, category_files) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (datetime.now().isoformat(timespec='seconds'), profile,
+                 str(profile_path) if profile_path else None, str(output), count, str(rng_seed),
+                 seed_plan[0], seed_plan[1], json.dumps(settings), json.dumps(category_files)))
+        return cursor.lastrowid
+
+    def add_prompts(self, run_id, rows):
+        """Index (line, prompt_text) rows of a run"""
+        with self.db:
+            self.db.executemany("INSERT INTO prompts (hash, run_id, line) VALUES (?, ?, ?)",
+                                ((prompt_hash(text), run_id, line) for line, text in rows))
+
+    def truncate_prompts(self, run_id, lines):
+        """Forget the prompts of a run after its first lines (when resuming it)"""
+        with self.db:
+            self.db.execute("DELETE FROM prompts WHERE run_id = ? AND line > ?", (run_id, lines))
+
+    def finish_run(self, run_id, lines, files):
+        with self.db:
+            self.db.execute("UPDATE runs SET finished = ?, lines = ?, files = ? WHERE id = ?",
+                            (datetime.now().isoformat(timespec='seconds'), lines, json.dumps(files), run_id))
+
+    def _rows(self, query, params=()):
+        cursor = self.db.execute(query, params)
+        columns = [c[0] for c in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor]
+
+    def list_runs(self, profile=None, since=None, limit=None):
+        """Runs, newest first, optionally of one profile and/or since an ISO date"""
+        query = "SELECT * FROM runs WHERE 1 = 1"
+        params = []
+        if profile:
+            query += " AND profile = ?"
+            params.append(profile)
+        if since:
+            query += " AND created >= ?"
+            params.append(since)
+        query += " ORDER BY created DESC, id DESC"
+        if limit:
+            query += f" LIMIT {int(limit)}"
+        return self._rows(query, params)
+
+    def find_prompt(self, prompt_text):
+        """Runs (with the matching line numbers) that wrote a prompt"""
+        return self._rows(
+            "SELECT runs.*, prompts.line FROM prompts JOIN runs ON runs.id = prompts.run_id "
+            "WHERE prompts.hash = ? ORDER BY runs.id, prompts.line", (prompt_hash(prompt_text),))
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class PromptRecorder(object):
+    """Pass (prompt_text, settings) jobs through, indexing each line in the manifest.
+
+    A line is indexed once the consumer comes back for the next job, i.e.
+    after it wrote the line, so a stream closed mid-write doesn't index a
+    line it never wrote. Rows are inserted in batches; flush() inserts the
+    pending ones, including the job currently handed out.
+    """
+    def __init__(self, manifest, run_id, jobs, start_lines=0):
+        self.manifest = manifest
+        self.run_id = run_id
+        self.jobs = jobs
+        self.start_lines = start_lines
+        self.batch = []
+        self.current = None
+
+    def __iter__(self):
+        try:
+            for line, job in enumerate(self.jobs, self.start_lines + 1):
+                self.current = (line, job[0])
+                yield job
+                if self.current:
+                    self.batch.append(self.current)
+                    self.current = None
+                if len(self.batch) >= PROMPT_BATCH:
+                    self.flush()
+        finally:
+            self.current = None
+            self.flush()
+
+    def flush(self):
+        if self.current:
+            self.batch.append(self.current)
+            self.current = None
+        if self.batch:
+            self.manifest.add_prompts(self.run_id, self.batch)
+            self.batch = []
@@ -0,0 +1,190 @@
+"""
+Exclusion / compatibility rules between category options.
+
+Rules live in a profile's profile.json:
+
+    "tags": {
+        "Clothing": {"formal": ["in a wedding dress", "in a business suit"]}
+    },
+    "rules": [
+        {"when": "Clothing:in a wedding dress", "excludes": ["Subject:Viking shield-maiden"]},
+        {"when": "Style:#monochrome", "requires": ["Color:#greyscale"]}
+    ]
+
+A selector is "Category:option text", "Category:#tag" or "#tag" (the tag in
+every category defining it). "excludes" forbids the matching options from
+appearing together with the "when" options; "requires" restricts each named
+category to the matching options whenever a "when" option is used.
+
+Both sides of a rule may name the same category; such a rule applies
+between the several options a category gets with "picks", and a warning is
+printed if the category only ever gets one.
+
+compile_rules() turns the rules into per-option bitmasks of the options
+still allowed in every category, so the sampler can pick valid prompts
+directly instead of generating and rejecting them.
+"""
+
+class CompiledRules(object):
+    """Pairwise option restrictions compiled from a profile's rules.
+
+    restrictions[cat][option] maps a category position to the bitmask of
+    its options that may be combined with that option; cat itself is in it
+    when the option restricts the other picks of its own category. The
+    table is symmetric: if a restricts b, b restricts a, so a sampler
+    walking the categories in order only has to look forward.
+    """
+    def __init__(self, sizes):
+        self.sizes = sizes
+        self.full_masks = [(1 << size) - 1 for size in sizes]
+        self.restrictions = [{} for _ in sizes]
+        # Per category cache of mask -> list of allowed option indices
+        self.mask_indices = [{} for _ in sizes]
+
+    def __bool__(self):
+        return any(self.restrictions)
+
+    def forbid(self, cat_a, option_a, cat_b, option_b):
+        """Forbid option_a of cat_a and option_b of cat_b in the same prompt"""
+        if (cat_a, option_a) == (cat_b, option_b):
+            # An option is never picked twice, so this can't be violated
+            return
+        self._clear(cat_a, option_a, cat_b, option_b)
+        self._clear(cat_b, option_b, cat_a, option_a)
+
+    def _clear(self, cat, option, other_cat, other_option):
+        allowed = self.restrictions[cat].setdefault(option, {})
+        mask = allowed.get(other_cat, self.full_masks[other_cat])
+        allowed[other_cat] = mask & ~(1 << other_option)
+
+    def restrict(self, cat, option, allowed):
+        """Apply an option's restrictions to the categories after cat.
+
+        Returns the new list of allowed masks (allowed itself if the option
+        has no restrictions), or None if a later category has no option left.
+        """
+        rules = self.restrictions[cat].get(option)
+        if not rules:
+            return allowed
+        restricted = None
+        for other_cat, mask in rules.items():
+            if other_cat <= cat:
+                continue
+            if restricted is None:
+                restricted = list(allowed)
+            restricted[other_cat] &= mask
+            if not restricted[other_cat]:
+                return None
+        return restricted if restricted is not None else allowed
+
+    def allowed(self, cat, chosen):
+        """Mask of cat's options that may join every (category, option) in chosen.
+
+        chosen may include earlier picks of cat itself.
+        """
+        mask = self.full_masks[cat]
+        for other_cat, option in chosen:
+            rules = self.restrictions[other_cat].get(option)
+            if rules and cat in rules:
+                mask &= rules[cat]
+        return mask
+
+    def indices(self, cat, mask):
+        """Option indices set in a mask (cached per distinct mask)"""
+        cache = self.mask_indices[cat]
+        indices = cache.get(mask)
+        if indices is None:
+            indices = [i for i in range(self.sizes[cat]) if mask >> i & 1]
+            if len(cache) < 4096:
+                cache[mask] = indices
+        return indices
+
+def _select(selector, category_names, option_lists, tags):
+    """Resolve a selector to a list of (category position, option index)"""
+    selector = selector.strip()
+    if ':' in selector and not selector.startswith('#'):
+        cat, _, value = selector.partition(':')
+        targets = [cat.strip()]
+    else:
+        value = selector
+        targets = list(category_names)
+    value = value.strip()
+
+    matches = []
+    for cat in targets:
+        if cat not in category_names:
+            print(f"Warning: rule refers to unknown category '{cat}'")
+            continue
+        cat_index = category_names.index(cat)
+        if value.startswith('#'):
+            wanted = {o.strip().lower() for o in tags.get(cat, {}).get(value[1:], [])}
+        else:
+            wanted = {value.lower()}
+        matches.extend((cat_index, i) for i, option in enumerate(option_lists[cat_index])
+                       if option.strip().lower() in wanted)
+    if not matches and len(targets) == 1:
+        print(f"Warning: rule selector '{selector}' matches no option")
+    return matches
+
+def _as_list(value):
+    if not value:
+        return []
+    return [value] if isinstance(value, str) else list(value)
+
+def _most_picks(value):
+    """Most options a "picks" value gives a category (checked properly by the sampler)"""
+    if isinstance(value, list) and len(value) == 2:
+        value = value[1]
+    return value if isinstance(value, int) else 1
+
+def _rule_pairs(rule, when, category_names, option_lists, tags):
+    """Yield every (cat_a, option_a, cat_b, option_b) pair a rule forbids"""
+    for selector in _as_list(rule.get('excludes')):
+        for cat_b, option_b in _select(selector, category_names, option_lists, tags):
+            for cat_a, option_a in when:
+                yield cat_a, option_a, cat_b, option_b
+
+    # Group required options per category; anything else there is forbidden
+    required = {}
+    for selector in _as_list(rule.get('requires')):
+        for cat_b, option_b in _select(selector, category_names, option_lists, tags):
+            required.setdefault(cat_b, set()).add(option_b)
+    for cat_b, keep in required.items():
+        for option_b in range(len(option_lists[cat_b])):
+            if option_b in keep:
+                continue
+            for cat_a, option_a in when:
+                yield cat_a, option_a, cat_b, option_b
+
+def compile_rules(category_names, option_lists, profile):
+    """Compile a profile's "rules" into a CompiledRules table.
+
+    A rule whose pairs all fall within categories that get one option per
+    prompt can never apply, and is reported.
+    """
+    compiled = CompiledRules([len(options) for options in option_lists])
+    tags = profile.get('tags', {}) if profile else {}
+    picks = (profile or {}).get('picks') or {}
+    for number, rule in enumerate((profile or {}).get('rules', []), 1):
+        if not isinstance(rule, dict) or 'when' not in rule:
+            raise ValueError(f"Rule {number} in profile.json needs a 'when' selector")
+        when = []
+        for selector in _as_list(rule['when']):
+            when.extend(_select(selector, category_names, option_lists, tags))
+
+        applies = False
+        single = set()
+        for cat_a, option_a, cat_b, option_b in _rule_pairs(rule, when, category_names, option_lists, tags):
+            compiled.forbid(cat_a, option_a, cat_b, option_b)
+            if cat_a != cat_b:
+                applies = True
+            elif option_a != option_b:
+                # Pairs within one category only matter if it gets several options
+                if _most_picks(picks.get(category_names[cat_a], 1)) > 1:
+                    applies = True
+                else:
+                    single.add(category_names[cat_a])
+        if single and not applies:
+            print(f"Warning: rule {number} only relates options of {', '.join(sorted(single))} "
+                  f"to each other, but they get one option per prompt, so it never applies")
+    return compiled
@@ -0,0 +1,193 @@
+"""
+Local prompt service for the A1111 Prompt Generator.
+
+Keeps option tables warm between requests so an orchestrator can ask for
+prompts one batch at a time without paying for a Python start-up and a
+re-read of every category file each time:
+
+    python cli.py serve Portraits Landscapes --port 7861
+    curl "http://127.0.0.1:7861/prompts?profile=Portraits&n=500&format=jsonl"
+
+Recently used profiles stay loaded, with their rules compiled, in a
+ProfileCache bounded by memory; a category file is re-read only when its
+size or modification time changes, and config/settings.txt is reloaded when
+it changes. Every request
+is handled on its own thread, so a large batch doesn't hold up others.
+"""
+import io
+import os
+import json
+import math
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+from engine import (
+    CONFIG_DIR, PROFILES_DIR, DEFAULT_SETTINGS, OUTPUT_FORMATS, ProfileCache, load_settings,
+    run_generation, setting_enabled, count_sweep_values, SWEEP_KEYS
+)
+
+# Most lines a single request may ask for (prompts times sweep combinations)
+MAX_BATCH = 100000
+
+CONTENT_TYPES = {
+    'a1111': 'text/plain; charset=utf-8',
+    'jsonl': 'application/x-ndjson; charset=utf-8',
+    'csv': 'text/csv; charset=utf-8',
+}
+
+class PromptService(object):
+    """Warm option tables and settings shared by all request threads"""
+    def __init__(self, profiles_dir=PROFILES_DIR):
+        self.profiles_dir = profiles_dir
+        self.cache = ProfileCache()
+        self._settings = None
+        self._settings_stamp = None
+        self._lock = threading.Lock()
+        # Runs with a persistent history filter are serialized per profile
+        self._history_locks = {}
+
+    def profile_path(self, name):
+        path = self.profiles_dir / name
+        if os.path.basename(name) != name or not (path / 'profile.json').exists():
+            raise LookupError(f"Unknown profile: {name}")
+        return path
+
+    def profile_names(self):
+        if not self.profiles_dir.exists():
+            return []
+        return sorted(p.name for p in self.profiles_dir.iterdir() if (p / 'profile.json').exists())
+
+    def settings(self):
+        """Current settings, reloaded when settings.txt changes"""
+        settings_file = CONFIG_DIR / 'settings.txt'
+        try:
+            stat = settings_file.stat()
+            stamp = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            stamp = None
+        with self._lock:
+            if self._settings is None or stamp != self._settings_stamp:
+                self._settings = load_settings()
+                self._settings_stamp = stamp
+            return dict(self._settings)
+
+    def warm(self, names):
+        """Load profiles ahead of the first request"""
+        normalize = setting_enabled(self.settings(), 'NORMALIZE_OPTIONS')
+        for name in names:
+            self.cache.get(self.profile_path(name), normalize)
+        print(f"Warmed {len(self.cache)} profiles ({self.cache.size / 2**20:.1f} MB)")
+
+    def generate(self, name, count, output_format='a1111', rng_seed=None, overrides=None):
+        """Generate count prompts for a profile, returning (text, result)"""
+        profile_path = self.profile_path(name)
+        settings = self.settings()
+        settings.update(overrides or {})
+        profile, options, negative_prompt, rules = self.cache.get(
+            profile_path, setting_enabled(settings, 'NORMALIZE_OPTIONS'))
+
+        buffer = io.StringIO()
+        lock = None
+        if setting_enabled(settings, 'DEDUP_HISTORY'):
+            with self._lock:
+                lock = self._history_locks.setdefault(name, threading.Lock())
+            lock.acquire()
+        try:
+            result = run_generation(profile.get('categories', []), options, settings, count,
+                                    f"<http:{name}>", negative_prompt, profile, profile_path,
+                                    rng_seed, stream=buffer, output_format=output_format, rules=rules)
+        finally:
+            if lock:
+                lock.release()
+        return buffer.getvalue(), result
+
+class PromptRequestHandler(BaseHTTPRequestHandler):
+    """GET /prompts?profile=X&n=500[&format=jsonl][&seed=N][&KEY=VALUE...] and GET /profiles"""
+    service = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if url.path == '/profiles':
+            self._send(200, json.dumps(self.service.profile_names()) + '\n', 'application/json')
+        elif url.path == '/prompts':
+            self._prompts(query)
+        else:
+            self._send(404, "Not found\n")
+
+    def _prompts(self, query):
+        try:
+            name = query.pop('profile')
+            count = int(query.pop('n', 100))
+            output_format = query.pop('format', 'a1111')
+            seed = query.pop('seed', None)
+            seed = int(seed) if seed is not None else None
+            if not 0 < count <= MAX_BATCH:
+                raise ValueError(f"n must be between 1 and {MAX_BATCH}")
+            if output_format not in OUTPUT_FORMATS:
+                raise ValueError(f"Unknown format: {output_format}")
+            # Any remaining parameter overrides a setting, e.g. &SEED_MODE=hash
+            overrides = {}
+            for key, value in query.items():
+                if key.upper() not in DEFAULT_SETTINGS:
+                    raise ValueError(f"Unknown parameter: {key}")
+                overrides[key.upper()] = value
+            # A grid sweep writes every prompt once per settings combination.
+            # Axes are counted, not expanded, so a huge range is rejected cheaply.
+            settings = self.service.settings()
+            settings.update(overrides)
+            sizes = [count_sweep_values(settings.get(key, DEFAULT_SETTINGS[key])) for key in SWEEP_KEYS]
+            if max(sizes) > MAX_BATCH:
+                raise ValueError(f"A sweep setting has {max(sizes)} values, more than {MAX_BATCH}")
+            lines = count
+            if str(settings.get('SWEEP', 'grid')).strip().lower() != 'sample':
+                lines *= math.prod(sizes)
+            if lines > MAX_BATCH:
+                raise ValueError(f"n times the sweep combinations is {lines} lines, more than {MAX_BATCH}")
+        except KeyError:
+            self._send(400, "Missing parameter: profile\n")
+            return
+        except ValueError as e:
+            self._send(400, f"{e}\n")
+            return
+
+        try:
+            text, result = self.service.generate(name, count, output_format, seed, overrides)
+        except LookupError as e:
+            self._send(404, f"{e}\n")
+            return
+        except (FileNotFoundError, ValueError) as e:
+            self._send(422, f"{e}\n")
+            return
+        self._send(200, text, CONTENT_TYPES[output_format],
+                   {'X-Run-Id': result['run_id'], 'X-RNG-Seed': result['rng_seed'],
+                    'X-Rejected': result['rejected']})
+
+    def _send(self, status, text, content_type='text/plain; charset=utf-8', headers=None):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            if value is not None:
+                self.send_header(key, str(value))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+def serve(host='127.0.0.1', port=7861, profiles=()):
+    """Run the prompt service until interrupted"""
+    service = PromptService()
+    service.warm(list(profiles))
+    handler = type('Handler', (PromptRequestHandler,), {'service': service})
+    server = ThreadingHTTPServer((host, port), handler)
+    print(f"Serving prompts on http://{host}:{server.server_address[1]}/prompts")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
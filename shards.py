@@ -0,0 +1,164 @@
+"""
+Sharded batches: one logical run generated on several machines.
+
+    host1$ python cli.py batch Portraits --count 1000000 --seed 42 --shard 1/4 --output shard1
+    host2$ python cli.py batch Portraits --count 1000000 --seed 42 --shard 2/4 --output shard2
+    ...
+    $ python cli.py merge shard1 shard2 shard3 shard4 --output merged
+
+A shard is a range of prompt positions of the run, either "i/n" (the i-th
+of n near-equal parts) or an explicit "start:end". Sharded runs draw every
+block of SHARD_BLOCK prompts from its own generator seeded from the run's
+seed, so a machine produces its slice without drawing the others and the
+slices of any split add up to the same run.
+
+There is no coordinator: every shard's manifest.json records its range,
+the seed, settings and category file hashes of the run and a checksum of
+every file it wrote. verify_shards() checks that a set of shard folders
+belongs to one run, covers it exactly once and arrived intact, and
+merge_shards() joins them in order.
+"""
+import os
+import json
+import shutil
+from datetime import datetime
+from pathlib import Path
+
+from engine import SHARD_BLOCK, seed_sidecar_path
+from manifest import file_sha256
+
+def parse_shard(spec, count):
+    """Turn "i/n" or "start:end" into a (start, end) range of count prompts"""
+    try:
+        if '/' in spec:
+            index, total = (int(part) for part in spec.split('/'))
+            if not 1 <= index <= total:
+                raise ValueError
+            # Split whole blocks so every shard starts on a block boundary
+            blocks = -(-count // SHARD_BLOCK)
+            start = blocks * (index - 1) // total * SHARD_BLOCK
+            end = min(count, blocks * index // total * SHARD_BLOCK)
+            return min(start, count), end
+        start, end = (int(part) for part in spec.split(':'))
+        return start, end
+    except ValueError:
+        raise ValueError(f"Invalid shard '{spec}': use i/n (e.g. 2/8) or start:end") from None
+
+def file_checksums(output_dir, files):
+    """SHA-256 of each file, keyed by its name inside output_dir"""
+    return {os.path.relpath(path, output_dir): file_sha256(path) for path in files}
+
+def run_files(result):
+    """Every file a batch run wrote that a merge carries over, seeds last"""
+    files = list(result['files'])
+    seeds = seed_sidecar_path(result['output'])
+    if seeds.exists():
+        files.append(str(seeds))
+    return files
+
+def load_shard(shard_dir):
+    """A shard folder's manifest.json, with the folder it came from"""
+    with open(Path(shard_dir) / 'manifest.json', 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    manifest['dir'] = str(shard_dir)
+    return manifest
+
+def verify_shards(manifests):
+    """Problems that keep a set of shard manifests from forming one run (empty if none)"""
+    problems = []
+    for manifest in manifests:
+        if not manifest.get('shard'):
+            problems.append(f"{manifest['dir']}: not a sharded batch")
+    if problems or not manifests:
+        return problems or ["No shards given"]
+
+    first = manifests[0]
+    for manifest in manifests[1:]:
+        for key in ('master_seed', 'count', 'settings'):
+            if manifest.get(key) != first.get(key):
+                problems.append(f"{manifest['dir']}: {key} differs from {first['dir']}")
+        profiles = {run['profile']: run.get('category_files') for run in manifest['runs']}
+        first_profiles = {run['profile']: run.get('category_files') for run in first['runs']}
+        if set(profiles) != set(first_profiles):
+            problems.append(f"{manifest['dir']}: profiles differ from {first['dir']}")
+        else:
+            problems.extend(f"{manifest['dir']}: category files of {name} differ from {first['dir']}"
+                            for name in profiles if profiles[name] != first_profiles[name])
+
+    position = 0
+    for manifest in sorted(manifests, key=lambda m: (m['shard']['start'], m['shard']['end'])):
+        start, end = manifest['shard']['start'], manifest['shard']['end']
+        if start > position:
+            problems.append(f"Prompts {position}:{start} are in no shard")
+        elif start < position:
+            problems.append(f"{manifest['dir']}: prompts {start}:{min(position, end)} are also in another shard")
+        position = max(position, end)
+    if position < first['count']:
+        problems.append(f"Prompts {position}:{first['count']} are in no shard")
+
+    for manifest in manifests:
+        for run in manifest['runs']:
+            if run.get('error'):
+                problems.append(f"{manifest['dir']}: {run['profile']} failed: {run['error']}")
+                continue
+            for name, checksum in run.get('checksums', {}).items():
+                path = Path(manifest['dir']) / name
+                if not path.exists():
+                    problems.append(f"{path}: missing")
+                elif file_sha256(path) != checksum:
+                    problems.append(f"{path}: contents don't match the manifest")
+    return problems
+
+def _merge_files(paths, output_path, header_lines=0):
+    """Concatenate files, keeping the first header_lines lines of the first one only"""
+    with open(output_path, 'wb') as out:
+        for number, path in enumerate(paths):
+            with open(path, 'rb') as f:
+                for _ in range(header_lines if number else 0):
+                    f.readline()
+                shutil.copyfileobj(f, out, 1 << 20)
+
+def merge_shards(manifests, output_dir):
+    """Join verified shards in prompt order into output_dir, returning the merged manifest"""
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    manifests = sorted(manifests, key=lambda m: m['shard']['start'])
+    runs = []
+    for run in manifests[0]['runs']:
+        name = run['profile']
+        shard_runs = [(manifest['dir'], next(r for r in manifest['runs'] if r['profile'] == name))
+                      for manifest in manifests]
+        # Files of one kind (format, chunk or seeds) by the suffix after the profile name
+        kinds = {}
+        for shard_dir, shard_run in shard_runs:
+            for file_name in shard_run.get('checksums', {}):
+                kind = file_name[len(name):].lstrip('-0123456789')
+                kinds.setdefault(kind, []).append(Path(shard_dir) / file_name)
+        files = []
+        for kind, paths in kinds.items():
+            output_path = output_dir / f"{name}{kind}"
+            if kind == '.csv':
+                _merge_files(paths, output_path, 1)
+            elif kind == '.seeds.txt':
+                _merge_files(paths, output_path, 3)
+            else:
+                _merge_files(paths, output_path)
+            files.append(output_path)
+        runs.append({
+            'profile': name,
+            'profile_path': run.get('profile_path'),
+            'lines': sum(shard_run['lines'] for _, shard_run in shard_runs),
+            'category_files': run.get('category_files'),
+            'checksums': file_checksums(output_dir, files),
+        })
+    merged = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'count': manifests[0]['count'],
+        'master_seed': manifests[0]['master_seed'],
+        'settings': manifests[0]['settings'],
+        'merged_from': [manifest['dir'] for manifest in manifests],
+        'runs': runs,
+    }
+    with open(output_dir / 'manifest.json', 'w', encoding='utf-8') as f:
+        json.dump(merged, f, indent=4)
+    return merged
@@ -0,0 +1,190 @@
+"""
+Prompt templates.
+
+By default a prompt is every category's option joined with ", " in list
+order. A profile's profile.json can lay the prompt out instead:
+
+    "template": "{Subject} {FacialExpression}[, wearing {Clothing}], {Situation}",
+    "prefixes": {"Lighting": "lit by "}
+
+{Category} stands for the category's option. [...] is an optional segment,
+left out whenever a category in it has no option in the prompt (e.g. one
+dropped to meet TOKEN_BUDGET); a category outside [...] without an option
+renders as nothing. Categories the template doesn't mention are drawn but
+not shown. "prefixes" puts text in front of a category's option wherever it
+appears, with or without a template. A category with several picks in a
+prompt (see "picks" in engine.category_picks) fills its slot with all of
+them, separated by ", ".
+
+compile_template() parses the template once into an assembly plan of
+literal and slot steps and prefixes every option up front, so rendering a
+prompt is a lookup per slot and a single join.
+"""
+import re
+
+from clip_tokens import option_token_counts, count_tokens, SEPARATOR
+
+# {Category}, [ and ] in a template
+TEMPLATE_TOKEN = re.compile(r'\{([^{}\[\]]+)\}|\[|\]')
+
+class CompiledTemplate(object):
+    """Assembly plan of a prompt template.
+
+    A choice has a column per category followed by the extra columns of
+    categories with several picks; category_columns lists the columns of
+    every category (the category's own first) and texts[column] holds the
+    options of a column with their prefix. With a template, parts is the
+    template's literal text with None in each slot, slots lists (part
+    position, category), multi_slots (part position, columns) for
+    categories with several picks and groups the optional segments as
+    (first part, end part, categories in it). Without one, render() joins
+    the options with ", " in category order. Option indices below 0 mark a
+    column left out of the prompt.
+    """
+    def __init__(self, texts, category_columns=None, parts=None, slots=None, groups=None):
+        self.texts = texts
+        if category_columns is None:
+            category_columns = [[column] for column in range(len(texts))]
+        self.category_columns = category_columns
+        # Columns in the order they appear in a joined prompt
+        self.order = [column for columns in category_columns for column in columns]
+        self.parts = parts
+        self.slots = slots or []
+        self.multi_slots = [(position, category_columns[cat_index]) for position, cat_index in self.slots
+                            if len(category_columns[cat_index]) > 1]
+        self.groups = groups or []
+        self.literal_counts = None
+        self.text_counts = None
+        self.joined_counts = None
+        if parts is None:
+            self.render = self._render_joined
+
+    def _render_joined(self, choice):
+        texts = self.texts
+        return ", ".join(texts[column][choice[column]] for column in self.order if choice[column] >= 0)
+
+    def _join_picks(self, columns, choice):
+        texts = self.texts
+        return ", ".join(texts[column][choice[column]] for column in columns if choice[column] >= 0)
+
+    def render(self, choice):
+        """Turn a tuple of option indices into the prompt text"""
+        parts = self.parts[:]
+        texts = self.texts
+        for position, cat_index in self.slots:
+            i = choice[cat_index]
+            if i < 0:
+                return self._render_partial(choice)
+            parts[position] = texts[cat_index][i]
+        for position, columns in self.multi_slots:
+            parts[position] = self._join_picks(columns, choice)
+        return ''.join(parts)
+
+    def _render_partial(self, choice):
+        """render() for a prompt with categories left out"""
+        parts = self.parts[:]
+        for position, cat_index in self.slots:
+            i = choice[cat_index]
+            parts[position] = self.texts[cat_index][i] if i >= 0 else ''
+        for position, columns in self.multi_slots:
+            parts[position] = self._join_picks(columns, choice)
+        for start, end, cat_indices in self.groups:
+            if any(choice[cat_index] < 0 for cat_index in cat_indices):
+                parts[start:end] = [''] * (end - start)
+        return ''.join(parts)
+
+    def token_count(self, choice):
+        """CLIP token count of the prompt a choice renders to, without rendering it.
+
+        Only used with a template; counts are computed on first use.
+        """
+        if self.text_counts is None:
+            self.text_counts = [option_token_counts(texts) for texts in self.texts]
+            self.joined_counts = [option_token_counts(texts, SEPARATOR) for texts in self.texts]
+            self.literal_counts = [count_tokens(part) if part else 0 for part in self.parts]
+        counts = self.literal_counts
+        slot_tokens = {position: self._slot_tokens(self.category_columns[cat_index], choice)
+                       for position, cat_index in self.slots}
+        tokens = sum(counts) + sum(slot_tokens.values())
+        for start, end, cat_indices in self.groups:
+            if any(choice[cat_index] < 0 for cat_index in cat_indices):
+                tokens -= sum(counts[start:end])
+                tokens -= sum(count for position, count in slot_tokens.items() if start <= position < end)
+        return tokens
+
+    def _slot_tokens(self, columns, choice):
+        """Tokens of one slot: its picks, each but the last followed by a separator"""
+        tokens = 0
+        last = None
+        for column in columns:
+            i = choice[column]
+            if i >= 0:
+                tokens += self.joined_counts[column][i]
+                last = column
+        if last is None:
+            return 0
+        i = choice[last]
+        return tokens - self.joined_counts[last][i] + self.text_counts[last][i]
+
+def _parse(template, category_names):
+    """Split a template into (parts, slots, groups)"""
+    parts = []
+    slots = []
+    groups = []
+    group_start = None
+    group_cats = None
+    pos = 0
+    for match in TEMPLATE_TOKEN.finditer(template):
+        if match.start() > pos:
+            parts.append(template[pos:match.start()])
+        pos = match.end()
+        token = match.group(0)
+        if token == '[':
+            if group_start is not None:
+                raise ValueError("Optional segments in the template can't be nested")
+            group_start = len(parts)
+            group_cats = []
+        elif token == ']':
+            if group_start is None:
+                raise ValueError("Unmatched ']' in the template")
+            groups.append((group_start, len(parts), group_cats))
+            group_start = None
+        else:
+            cat = match.group(1).strip()
+            if cat not in category_names:
+                raise ValueError(f"The template refers to unknown category '{cat}'")
+            cat_index = category_names.index(cat)
+            slots.append((len(parts), cat_index))
+            parts.append(None)
+            if group_cats is not None:
+                group_cats.append(cat_index)
+    if group_start is not None:
+        raise ValueError("Unmatched '[' in the template")
+    if pos < len(template):
+        parts.append(template[pos:])
+    return parts, slots, groups
+
+def compile_template(category_names, option_lists, profile, extra_columns=()):
+    """Compile a profile's "template" and "prefixes" into a CompiledTemplate.
+
+    extra_columns gives the category of every extra column of a choice
+    (one per pick beyond the first, see engine.extra_columns).
+    """
+    profile = profile or {}
+    prefixes = profile.get('prefixes') or {}
+    for cat in prefixes:
+        if cat not in category_names:
+            print(f"Warning: prefix given for unknown category '{cat}'")
+    texts = []
+    for cat, options in zip(category_names, option_lists):
+        prefix = prefixes.get(cat, '')
+        texts.append([prefix + option for option in options] if prefix else options)
+    category_columns = [[cat_index] for cat_index in range(len(texts))]
+    for column, cat_index in enumerate(extra_columns, len(texts)):
+        category_columns[cat_index].append(column)
+    texts.extend(texts[cat_index] for cat_index in extra_columns)
+
+    template = profile.get('template')
+    if not template:
+        return CompiledTemplate(texts, category_columns)
+    return CompiledTemplate(texts, category_columns, *_parse(template, list(category_names)))
@@ -0,0 +1,199 @@
+"""
+Preflight validation of a profile's category files.
+
+Checks every file a run is going to read and reports all problems at once,
+before any output is written:
+
+- errors: missing files, files with no options, text that isn't UTF-8 and
+  double quotes, which break the --prompt "..." quoting A1111 parses
+- warnings: a UTF-8 byte order mark (it ends up in the first option) and
+  duplicate lines or negative prompt terms, ignoring case and whitespace
+
+Results are cached in config/validation_cache.json by the SHA-256 of each
+file's contents, so only files that changed since the last run are checked
+again. The cache also remembers each file's modification time and size, so
+an unchanged file isn't even read.
+"""
+import os
+import json
+import hashlib
+import threading
+
+from engine import CONFIG_DIR, find_case_insensitive_file
+
+CACHE_FILENAME = 'validation_cache.json'
+
+# Bump when the checks change so cached results are recomputed
+VALIDATOR_VERSION = 1
+
+# Cached results kept, oldest dropped first
+MAX_CACHE_ENTRIES = 5000
+
+ERROR = 'error'
+WARNING = 'warning'
+
+def _normalized(text):
+    return ' '.join(text.split()).casefold()
+
+def _decode_lines(data, issues):
+    """Split file contents into (line number, text), recording undecodable lines"""
+    lines = []
+    for number, raw in enumerate(data.split(b'\n'), 1):
+        try:
+            lines.append((number, raw.decode('utf-8').rstrip('\r')))
+        except UnicodeDecodeError as e:
+            issues.append([ERROR, number, f"not valid UTF-8 ({e.reason} at byte {e.start})"])
+    return lines
+
+def check_category(data):
+    """Issues in the contents of a category file, as [severity, line, message] lists"""
+    issues = []
+    if data.startswith(b'\xef\xbb\xbf'):
+        issues.append([WARNING, 1, "starts with a byte order mark, which becomes part of the first option"])
+        data = data[3:]
+    seen = {}
+    options = 0
+    for number, text in _decode_lines(data, issues):
+        option = text.strip()
+        if not option:
+            continue
+        options += 1
+        if '"' in option:
+            issues.append([ERROR, number, "contains a double quote, which breaks the --prompt quoting"])
+        key = _normalized(option)
+        if key in seen:
+            issues.append([WARNING, number, f"duplicate of line {seen[key]}"])
+        else:
+            seen[key] = number
+    if not options:
+        issues.append([ERROR, None, "has no options"])
+    return issues
+
+def check_negative_prompt(data):
+    """Issues in the contents of a NegativePrompt.txt"""
+    issues = []
+    if data.startswith(b'\xef\xbb\xbf'):
+        data = data[3:]
+    seen = set()
+    duplicates = []
+    for number, text in _decode_lines(data, issues):
+        if '"' in text:
+            issues.append([ERROR, number, "contains a double quote, which breaks the --negative_prompt quoting"])
+        for term in text.split(','):
+            key = _normalized(term)
+            if not key:
+                continue
+            if key in seen and key not in duplicates:
+                duplicates.append(key)
+            seen.add(key)
+    if duplicates:
+        issues.append([WARNING, None, "repeats terms: " + ", ".join(duplicates)])
+    return issues
+
+CHECKS = {
+    'category': check_category,
+    'negative': check_negative_prompt,
+}
+
+class ValidationCache(object):
+    """Validation results keyed by check kind and file content hash.
+
+    stats maps a file (kind and resolved path) to [mtime_ns, size, key of
+    its results] as of its last check.
+    """
+    def __init__(self, path=None):
+        self.path = path or CONFIG_DIR / CACHE_FILENAME
+        self.entries = {}
+        self.stats = {}
+        self.dirty = False
+        self._lock = threading.Lock()
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                saved = json.load(f)
+            if saved.get('version') == VALIDATOR_VERSION:
+                self.entries = saved.get('files', {})
+                self.stats = saved.get('stats', {})
+        except (OSError, ValueError):
+            pass
+
+    def check(self, path, kind='category'):
+        """Issues of one file, from the cache if its contents were checked before"""
+        stat = os.stat(path)
+        file_key = f"{kind}:{os.path.realpath(path)}"
+        with self._lock:
+            known = self.stats.get(file_key)
+            if known and known[:2] == [stat.st_mtime_ns, stat.st_size] and known[2] in self.entries:
+                return self.entries[known[2]]
+        with open(path, 'rb') as f:
+            data = f.read()
+        key = f"{kind}:{hashlib.sha256(data).hexdigest()}"
+        with self._lock:
+            issues = self.entries.get(key)
+        if issues is None:
+            issues = CHECKS[kind](data)
+        with self._lock:
+            self.entries[key] = issues
+            self.stats[file_key] = [stat.st_mtime_ns, stat.st_size, key]
+            self.dirty = True
+        return issues
+
+    def save(self):
+        """Write the cache back if anything new was checked"""
+        with self._lock:
+            if not self.dirty:
+                return
+            entries = list(self.entries.items())[-MAX_CACHE_ENTRIES:]
+            stats = list(self.stats.items())[-MAX_CACHE_ENTRIES:]
+            self.dirty = False
+        temp_path = f"{self.path}.tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({'version': VALIDATOR_VERSION, 'files': dict(entries), 'stats': dict(stats)}, f)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            print(f"Warning: could not save validation cache: {e}")
+
+def validate_profile(category_names, data_dir=None, cache=None):
+    """Check every file a run of these categories reads.
+
+    Returns a list of (file name, severity, line number or None, message),
+    errors first. Pass a ValidationCache to reuse it between calls; without
+    one the default cache is loaded and saved.
+    """
+    own_cache = cache is None
+    if own_cache:
+        cache = ValidationCache()
+    files = [(f"{cat}.txt", 'category') for cat in category_names]
+    files.append(("NegativePrompt.txt", 'negative'))
+
+    problems = []
+    for base_name, kind in files:
+        filename = find_case_insensitive_file(base_name, data_dir)
+        if not filename:
+            if kind == 'category':
+                problems.append((base_name, ERROR, None, "file not found"))
+            continue
+        try:
+            issues = cache.check(filename, kind)
+        except OSError as e:
+            problems.append((filename.name, ERROR, None, f"could not be read ({e})"))
+            continue
+        problems.extend((filename.name, severity, line, message) for severity, line, message in issues)
+
+    if own_cache:
+        cache.save()
+    problems.sort(key=lambda problem: problem[1] != ERROR)
+    return problems
+
+def format_problems(problems, limit=None):
+    """Human readable report, one problem per line (at most limit lines)"""
+    lines = []
+    for name, severity, line, message in problems[:limit]:
+        where = f"{name}:{line}" if line else name
+        lines.append(f"{severity}: {where} {message}")
+    if limit and len(problems) > limit:
+        lines.append(f"... and {len(problems) - limit} more")
+    return "\n".join(lines)
+
+def has_errors(problems):
+    return any(problem[1] == ERROR for problem in problems)